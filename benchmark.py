@@ -0,0 +1,144 @@
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+import bridgegraph
+import gamegraph
+
+# Benchmarks for graph building and the solvers on generated bridge puzzles
+# A puzzle has a carrier and n passengers with random transit weights; the carrier crosses with any number of
+# passengers given by the arities, and every state is valid.  Each phase is timed separately, and the results are
+# printed (or written to a file) as one JSON object per line, so that runs can be compared
+# Example:  python benchmark.py --sizes 8 10 12 --arities 1 2 --seed 1 --output bench_output.txt
+
+class RandomCrossingGraph(bridgegraph.BridgeGameGraph):
+    def __init__(self,mode,num_objects,arities,seed,max_weight=20,deferred_edges=False):
+        self.arities = set(arities)
+        self.carrier = "carrier"
+        weight_gen = random.Random(seed)
+        self.transit_weights = {"carrier" : 0}
+        for obj_num in range(num_objects):
+            self.transit_weights["p{:03d}".format(obj_num)] = weight_gen.randint(1,max_weight)
+
+        super().__init__(list(self.transit_weights),mode,trans_class=bridgegraph.CrossingAtNightEdge,compact_keys=True,
+                         deferred_edges=deferred_edges)
+
+    def transit_weight(self,obj):
+        return self.transit_weights[obj]
+
+def count_edges(graph):
+    return sum(len(vertex.edges_out) for key,vertex in graph.iterate_states())
+
+# Run one phase and return its record
+# "phase_func" returns a dictionary of phase-specific results, which is merged into the record
+def run_phase(phase,params,phase_func,measure_memory):
+    if measure_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    results = phase_func()
+    elapsed = time.perf_counter() - start_time
+    record = dict(params)
+    record["phase"] = phase
+    record["seconds"] = elapsed
+    if measure_memory:
+        record["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    record.update(results)
+    return record
+
+# Generate the records of all phases for one puzzle
+# Enumerating paths with dfs_solve is exponential even when bounded, so it is skipped above dfs_max_objects
+def benchmark_puzzle(num_objects,arities,seed,dfs_limit,dfs_max_objects,measure_memory,deferred_edges=False):
+    params = {"objects" : num_objects, "arities" : sorted(arities), "seed" : seed, "deferred_edges" : deferred_edges}
+    src = 0
+
+    eager_holder = dict()
+    def eager_build():
+        graph = RandomCrossingGraph("eager",num_objects,arities,seed,deferred_edges=deferred_edges)
+        eager_holder["graph"] = graph
+        return {"states" : len(graph.graph), "edges" : count_edges(graph)}
+    yield run_phase("eager_build",params,eager_build,measure_memory)
+    eager_graph = eager_holder["graph"]
+    dst = eager_graph.full_mask
+
+    def reachable_build():
+        graph = RandomCrossingGraph("reachable",num_objects,arities,seed,deferred_edges=deferred_edges)
+        graph.build_reachable(src)
+        return {"states" : len(graph.graph), "edges" : count_edges(graph)}
+    yield run_phase("reachable_build",params,reachable_build,measure_memory)
+
+    def lazy_bfs():
+        graph = RandomCrossingGraph("lazy",num_objects,arities,seed,deferred_edges=deferred_edges)
+        path = gamegraph.bfs_solve(graph,src,dst)
+        return {"states" : len(graph.graph), "path_length" : len(path)}
+    yield run_phase("lazy_bfs",params,lazy_bfs,measure_memory)
+
+    def bfs():
+        path = gamegraph.bfs_solve(eager_graph,src,dst)
+        return {"path_length" : len(path)}
+    yield run_phase("bfs_solve",params,bfs,measure_memory)
+
+    dijkstra_holder = dict()
+    def dijkstra():
+        path = gamegraph.dijkstra(eager_graph,src,dst)
+        dijkstra_holder["cost"] = gamegraph.weighted_path_cost(path)
+        dijkstra_holder["length"] = len(path)
+        return {"path_length" : len(path), "cost" : dijkstra_holder["cost"]}
+    yield run_phase("dijkstra",params,dijkstra,measure_memory)
+
+    def dfs_bounded():
+        # Optimal solutions which are no longer than the one found by dijkstra (at most dfs_limit of them)
+        solutions = 0
+        for solution in gamegraph.dfs_solve(eager_graph,src,dst,max_depth=dijkstra_holder["length"],max_cost=dijkstra_holder["cost"]):
+            solutions += 1
+            if solutions >= dfs_limit:
+                break
+        return {"max_depth" : dijkstra_holder["length"], "max_cost" : dijkstra_holder["cost"], "solutions" : solutions}
+    if num_objects <= dfs_max_objects:
+        yield run_phase("dfs_solve_bounded",params,dfs_bounded,measure_memory)
+
+    def dfs_pruned():
+        # The same search, skipping the states from which dst is out of reach within the bounds
+        solutions = 0
+        for solution in gamegraph.dfs_solve(eager_graph,src,dst,max_depth=dijkstra_holder["length"],max_cost=dijkstra_holder["cost"],prune_dead=True):
+            solutions += 1
+            if solutions >= dfs_limit:
+                break
+        return {"max_depth" : dijkstra_holder["length"], "max_cost" : dijkstra_holder["cost"], "solutions" : solutions}
+    if num_objects <= dfs_max_objects:
+        yield run_phase("dfs_solve_pruned",params,dfs_pruned,measure_memory)
+
+    def lazy_dijkstra():
+        graph = RandomCrossingGraph("lazy",num_objects,arities,seed,deferred_edges=deferred_edges)
+        path = gamegraph.dijkstra(graph,src,dst)
+        return {"states" : len(graph.graph), "path_length" : len(path), "cost" : gamegraph.weighted_path_cost(path)}
+    yield run_phase("lazy_dijkstra",params,lazy_dijkstra,measure_memory)
+
+    def astar():
+        graph = RandomCrossingGraph("lazy",num_objects,arities,seed,deferred_edges=deferred_edges)
+        path = gamegraph.astar_solve(graph,src,dst,bridgegraph.crossing_trips_heuristic)
+        return {"states" : len(graph.graph), "path_length" : len(path), "cost" : gamegraph.weighted_path_cost(path)}
+    yield run_phase("lazy_astar",params,astar,measure_memory)
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Benchmark graph building and solvers on generated bridge puzzles")
+    parser.add_argument("--sizes",type=int,nargs="+",default=[6,8,10,12],help="numbers of passengers")
+    parser.add_argument("--arities",type=int,nargs="+",default=[1,2],help="numbers of passengers that may cross together")
+    parser.add_argument("--seed",type=int,default=0,help="seed for the transit weights")
+    parser.add_argument("--dfs-limit",type=int,default=100,help="stop the bounded DFS after this many solutions")
+    parser.add_argument("--dfs-max-objects",type=int,default=6,help="skip the bounded DFS for larger puzzles")
+    parser.add_argument("--no-memory",action="store_true",help="do not measure peak memory (tracemalloc slows the phases down)")
+    parser.add_argument("--deferred-edges",action="store_true",help="build the graphs with deferred_edges=True")
+    parser.add_argument("--output",help="file to append the JSON lines to (default: standard output)")
+    args = parser.parse_args()
+
+    out_file = open(args.output,"a") if args.output else sys.stdout
+    for num_objects in args.sizes:
+        for record in benchmark_puzzle(num_objects,args.arities,args.seed,args.dfs_limit,args.dfs_max_objects,not args.no_memory,args.deferred_edges):
+            out_file.write(json.dumps(record) + "\n")
+            out_file.flush()
+    if args.output:
+        out_file.close()
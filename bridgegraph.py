@@ -1,11 +1,20 @@
+import itertools
+
 import gamegraph
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # The bridge game is always the same, with variations
 # A set of objects must be transported from an origin to a destination
 # via a means such as a boat, bridge, etc.
 # Certain constraints exist on who can cross and when
 # As a convention, we use a sorted list of object names as key components
 # The key represents the set of objects on the destination shore
+# Internally the set is also held as an integer bitmask: bit i is set when sorted_objects[i] is on the destination shore.
+# In compact key mode the bitmask itself is the key, so hashing and comparison are plain integer operations
 
 def get_bridge_key(graph,target_set):
     sorted_names = graph.get_sorted_objects()
@@ -17,255 +26,308 @@ def get_bridge_key(graph,target_set):
 
     return my_key
 
-# Helpers for generating outgoing states
-# Given a configuration of people on both shores, the function gen_outgoing_keys will generate keys representing valid states
-# to transfer into
-TRIP_MADE="trip_made"
-TRIP_NOT_MADE="trip_not_made"
-TRIP_IMPOSSIBLE="trip_impossible"
-
-class TripCounter(object):
-    def __init__(self,size):
-        self.trips_made = 0
-        self.trips_not_made = size
-        self.trips_impossible = 0
-        self.trip_list = [TRIP_NOT_MADE] * size
-
-    def set_trip(self,idx,val):
-        tlist = self.trip_list
-        if tlist[idx] == TRIP_MADE:
-            self.trips_made -= 1
-        elif tlist[idx] == TRIP_NOT_MADE:
-            self.trips_not_made -= 1
-        elif tlist[idx] == TRIP_IMPOSSIBLE:
-            self.trips_impossible -= 1
-
-        tlist[idx] = val
-        if tlist[idx] == TRIP_MADE:
-            self.trips_made += 1
-        elif tlist[idx] == TRIP_NOT_MADE:
-            self.trips_not_made += 1
-        elif tlist[idx] == TRIP_IMPOSSIBLE:
-            self.trips_impossible += 1
+def get_bridge_key_from_mask(graph,mask):
+    # Same string as get_bridge_key, for a bitmask
+    my_key = ""
+    for game_obj in graph.mask_to_names(mask):
+        my_key += game_obj
+        my_key += "/"
+
+    return my_key
+
+# The first class in the method resolution order of "cls" which defines the attribute "name" itself
+def defining_class(cls,name):
+    for base_class in cls.__mro__:
+        if name in vars(base_class):
+            return base_class
+    return None
 
 class BridgeGameKey(object):
-    def __init__(self,graph,target_set):
-        self.target_set = set(target_set)
-        self.cached_string_key = get_bridge_key(graph,self.target_set)
+    # Either the target set or the mask may be given; the other is derived from it
+    # The string form is only built when the key is printed
+    def __init__(self,graph,target_set=None,mask=None):
+        self.graph = graph
+        if mask is None:
+            self.target_set = set(target_set)
+            self.mask = graph.get_mask(self.target_set)
+        else:
+            self.target_set = None
+            self.mask = mask
+        self.cached_string_key = None
 
     def __hash__(self):
-        return hash(self.cached_string_key)
+        return hash(self.mask)
 
     def __eq__(self,other):
-        return self.cached_string_key == str(other)
+        return isinstance(other,BridgeGameKey) and self.mask == other.mask
 
     def __str__(self):
+        if self.cached_string_key is None:
+            self.cached_string_key = get_bridge_key_from_mask(self.graph,self.mask)
         return self.cached_string_key
 
+    def __getstate__(self):
+        # The graph is not pickled with the key; see BridgeGameGraph.adopt_key()
+        return {"graph" : None, "target_set" : self.target_set, "mask" : self.mask, "cached_string_key" : None}
+
+    def get_mask(self):
+        return self.mask
+
     def get_target_set(self):
+        if self.target_set is None:
+            self.target_set = self.graph.mask_to_set(self.mask)
         return self.target_set  
 
 class BridgeGameVertex(gamegraph.GameVertex):
+    __slots__ = ()
+
+    def __str__(self):
+        return self.graph.key_to_string(self.key)
+
+    def get_target_mask(self):
+        return self.graph.key_to_mask(self.key)
+
+    def get_target_set(self):
+        return self.graph.mask_to_set(self.get_target_mask())
+
+    def is_on_destination(self,obj):
+        return (self.get_target_mask() & self.graph.object_bits[obj]) != 0
+
+    def gen_incoming_keys(self):
+        # A crossing can always be undone by the same objects crossing back (validity aside), so the candidate
+        # predecessors of a state are exactly its candidate successors
+        return self.gen_outgoing_keys()
+
     # Generate transitions between states for the case of a boat, a flashlight, etc that supports N objects
     # The boat or flashlight is itself an object, but obviously its behavior is fixed by its position in the source state
     # The other objects move with the boat
-    # This function works by enumerating all transitions and selecting those which move the right number of objects in the right direction
-    # A faster function would select subsets directly, but is harder to understand and implement
+    # The moving objects are chosen directly: every subset of the objects on the carrier's shore whose size is one of the arities
 
     def gen_outgoing_keys(self):
-        arities = self.graph.arities
-        carrier = self.graph.carrier
-
-#        print("source vx {}".format(src_vx.get_key()))
-        src_set = self.key.get_target_set()
-        state_card = len(self.graph.sorted_objects)
-        # Precompute: create the flag list, the template, the initial xor...
-        flag_list = [False] * (state_card+1)
-        template_list = [False] * state_card
-        trip_counter = TripCounter(state_card)
-        carrier_idx = -1
-        carrier_on_dest = carrier in src_set
-        objnames = self.graph.sorted_objects
-
-#        print("\n\n\nsource vertex {}".format(src_vx))       
-        for idx in range(0,state_card):
-#            print ("init considering object {}".format(self.sorted_objects[idx]))
-            if objnames[idx] == carrier:
-                carrier_idx = idx
-                flag_list[idx] = not carrier_on_dest
-            else:
-                template_list[idx] = objnames[idx] in src_set
-
-                trip = TRIP_NOT_MADE if not template_list[idx] else (TRIP_MADE if carrier_on_dest == template_list[idx] else TRIP_IMPOSSIBLE)
-#                print("trip {}".format(trip))
-                trip_counter.set_trip(idx, trip)
-
-        current_set = set()
-        if not carrier_on_dest:
-            current_set.add(carrier)
-
-        while not flag_list[-1]:
-#            print (">>>trips made {} trips not made {} trips impossible {} for set {}".format(trip_counter.trips_made,trip_counter.trips_not_made,trip_counter.trips_impossible,get_bridge_key(self,current_set)))
-            if trip_counter.trips_impossible == 0 and trip_counter.trips_made in arities:
-                outgoing_key = BridgeGameKey(self.graph,current_set)
-                yield outgoing_key
-
-            # Update
-            for idx in range(0,state_card+1):
-                # NOTE:  The carrier's motion is fixed
- #               if idx < state_card:
- #                   print ("considering object {}".format(self.sorted_objects[idx]))
-                if idx != carrier_idx:
-                    if flag_list[idx]:
-                        # Remove
-                        flag_list[idx] = False
-                        if idx < state_card:
-                            current_set.remove(objnames[idx])
-                            trip = TRIP_NOT_MADE if not template_list[idx] else (TRIP_MADE if carrier_on_dest == template_list[idx] else TRIP_IMPOSSIBLE)
-#                            print("trip {}".format(trip))
-                            trip_counter.set_trip(idx, trip)
-                    else:
-                        # Add
-                        flag_list[idx] = True
-                        if idx < state_card:
-                            current_set.add(objnames[idx])
-                            trip = TRIP_NOT_MADE if template_list[idx] else (TRIP_MADE if carrier_on_dest == template_list[idx] else TRIP_IMPOSSIBLE)
-#                            print("trip {}".format(trip))
-                            trip_counter.set_trip(idx, trip)
-                        break        
+        graph = self.graph
+        src_mask = self.get_target_mask()
+        carrier_bit = graph.object_bits[graph.carrier]
+
+        # The objects on the same shore as the carrier, without the carrier itself
+        shore_mask = src_mask if src_mask & carrier_bit else ~src_mask & graph.full_mask
+        movable_bits = [bit for bit in graph.object_bit_list if bit & shore_mask and bit != carrier_bit]
+
+        flipped_src = src_mask ^ carrier_bit
+        for arity in sorted(graph.arities):
+            for moved_bits in itertools.combinations(movable_bits,arity):
+                yield graph.key_from_mask(flipped_src ^ sum(moved_bits))
 
 class BridgeGameEdge(gamegraph.GameEdge):
+    # Only the two masks of moved objects are stored.  The key is both masks packed into one integer, and the name
+    # is built from the masks when it is asked for
+    __slots__ = ("moved_to_mask","moved_from_mask")
+
     def __init__(self,src,dst,graph):
-        # The name is determined by the set differences between the target sets
-        src_target = src.get_key().get_target_set()
-        dst_target = dst.get_key().get_target_set()
+        # The name is determined by the set differences between the target sets, taken on the bitmasks
+        src_mask = graph.key_to_mask(src.get_key())
+        dst_mask = graph.key_to_mask(dst.get_key())
 
-#        print("src {} dst {}".format(str(src_target),str(dst_target)))
+#        print("src {} dst {}".format(str(src_mask),str(dst_mask)))
 
-        moved_to_shore = dst_target.difference(src_target)
-        moved_from_shore = src_target.difference(dst_target)
+        self.moved_to_mask = dst_mask & ~src_mask
+        self.moved_from_mask = src_mask & ~dst_mask
 
-        self.moved_to_shore = moved_to_shore
-        self.moved_from_shore = moved_from_shore
+        super().__init__(src,dst,graph)
+        super().set_key(self.moved_to_mask | (self.moved_from_mask << len(graph.sorted_objects)))
 
+    @property
+    def moved_to_shore(self):
+        return self.graph.mask_to_names(self.moved_to_mask)
+
+    @property
+    def moved_from_shore(self):
+        return self.graph.mask_to_names(self.moved_from_mask)
+
+    def get_name(self):
         my_name = ""
-        my_key_list = list()
+        moved_to_shore = self.moved_to_shore
         if moved_to_shore:
             my_name += "moved to destination: "
             for obj_name in moved_to_shore:
-                my_key_list.append("+{}".format(obj_name))
                 my_name += obj_name
                 my_name += ", "
+        moved_from_shore = self.moved_from_shore
         if moved_from_shore:
             my_name += "moved to origin: "
             for obj_name in moved_from_shore:
-                my_key_list.append("-{}".format(obj_name))
                 my_name += obj_name
                 my_name += ", "
-
-        my_key = "/".join(sorted(my_key_list))
-#        print("Created transition {} called {}".format(my_key,my_name))
-        super().__init__(src,dst,graph)
-        super().set_key(my_key)
-        super().set_name(my_name)
-        
+        return my_name
 
 class BridgeGameGraph(gamegraph.GameGraph):
-    def __init__(self,objects,mode,state_class=BridgeGameVertex,trans_class=BridgeGameEdge):
+    # If compact_keys is True, state keys are plain integer bitmasks instead of BridgeGameKey objects
+    def __init__(self,objects,mode,state_class=BridgeGameVertex,trans_class=BridgeGameEdge,compact_keys=False,incoming_edges=False,stats=None,deferred_edges=False):
         if len(set(objects)) < len(objects):
             raise RuntimeError("Objects have duplicate names")
        
         objects = sorted(objects)
         self.sorted_objects = objects
+        self.object_bits = {obj : 1 << idx for idx,obj in enumerate(objects)}
+        self.object_bit_list = [1 << idx for idx in range(len(objects))]
+        self.full_mask = (1 << len(objects)) - 1
+        self.compact_keys = compact_keys
 
-        super().__init__(state_class,trans_class,mode)
+        super().__init__(state_class,trans_class,mode,incoming_edges,stats,deferred_edges)
 
     def get_sorted_objects(self):
         return self.sorted_objects
 
+    def get_mask(self,target_set):
+        # Names which are not objects of this graph are ignored, as in get_bridge_key
+        mask = 0
+        for obj in target_set:
+            mask |= self.object_bits.get(obj,0)
+        return mask
+
+    def mask_to_names(self,mask):
+        # The names of the objects in the mask, in sorted order
+        names = list()
+        idx = 0
+        while mask:
+            if mask & 1:
+                names.append(self.sorted_objects[idx])
+            mask >>= 1
+            idx += 1
+        return names
+
+    def mask_to_set(self,mask):
+        return set(self.mask_to_names(mask))
+
+    def make_key(self,target_set):
+        # Build a state key of the right kind from a set of object names on the destination shore
+        return self.key_from_mask(self.get_mask(target_set))
+
+    def key_from_mask(self,mask):
+        if self.compact_keys:
+            return mask
+        return BridgeGameKey(self,mask=mask)
+
+    def key_to_mask(self,key):
+        if self.compact_keys:
+            return key
+        return key.get_mask()
+
+    # Keys as integers for external_bfs_solve
+    def key_to_int(self,key):
+        return self.key_to_mask(key)
+
+    def int_to_key(self,value):
+        return self.key_from_mask(value)
+
+    def adopt_key(self,key):
+        if not self.compact_keys:
+            key.graph = self
+        return key
+
+    def unattended_shore(self,masks):
+        # The objects on the shore without the carrier, as a mask
+        # Only integer operations are used, so "masks" may be an int or a NumPy array of them
+        carrier_flag = (masks >> self.object_bits[self.carrier].bit_length() - 1) & 1
+        return masks ^ (-carrier_flag & self.full_mask)
+
+    def key_to_string(self,key):
+        return get_bridge_key_from_mask(self,self.key_to_mask(key))
+
+    # Masks checked by batch_is_valid() at a time, so that large graphs do not need an array of all 2^n masks at once
+    BATCH_VALID_CHUNK = 1 << 20
+
+    def define_states(self):
+        # If the vertex class has a batch_is_valid(graph,masks) function and NumPy is available, all 2^n masks are checked
+        # with a few array operations and only the valid states are created.  Otherwise each key is checked in create_state()
+        # The batch check is only used if it is defined by the same class as is_valid(): a derived class which adds a rule
+        # to is_valid() without a batch_is_valid() of its own must not be checked with its base class's
+        batch_is_valid = getattr(self.state_class,"batch_is_valid",None)
+        if (batch_is_valid is None or numpy is None or len(self.sorted_objects) > 62 or
+            defining_class(self.state_class,"batch_is_valid") is not defining_class(self.state_class,"is_valid")):
+            return super().define_states()
+
+        for chunk_start in range(0,self.full_mask+1,self.BATCH_VALID_CHUNK):
+            chunk_masks = numpy.arange(chunk_start,min(chunk_start+self.BATCH_VALID_CHUNK,self.full_mask+1),dtype=numpy.int64)
+            if self.stats is None:
+                valid_masks = chunk_masks[batch_is_valid(self,chunk_masks)].tolist()
+            else:
+                valid_masks = chunk_masks[self.stats.timed_call("batch_is_valid",batch_is_valid,self,chunk_masks)].tolist()
+                self.stats.states_created += len(valid_masks)
+                self.stats.states_invalid += len(chunk_masks) - len(valid_masks)
+            for mask in valid_masks:
+                self.add_state(self.state_class(self.key_from_mask(mask),self))
+
     def gen_all_keys(self):
         # A tricky procedure, but commonplace
         # Construct all subsets.  Warning: EXPONENTIAL!
         # Each target set is checked using the derived class's verify_state() function
 
-        state_card = len(self.sorted_objects)
-        flag_list = [False] * (state_card+1)
-        current_set = set()
-
-        while not flag_list[-1]:
-            new_key = BridgeGameKey(self,current_set)
-            yield new_key # Someone is asking for the key
-                
-            # Remove all elements on the other shore and add the first one that isn't
-            for idx in range(0,state_card+1):
-                if flag_list[idx]:
-                    # Remove
-                    if idx < state_card:
-                        current_set.remove(self.sorted_objects[idx])
-                    flag_list[idx] = False
-                else:
-                    # Add
-                    if idx < state_card:
-                        current_set.add(self.sorted_objects[idx])
-                    flag_list[idx] = True
-                    break
+        # With bitmasks this is just counting from 0 to 2^n - 1
+        for mask in range(0,self.full_mask+1):
+            yield self.key_from_mask(mask) # Someone is asking for the key
 
 class GoatBridgeGameVertex(BridgeGameVertex):
+    __slots__ = ()
+
     # This function defines whether the vertex represents a valid state for the goat/wolf/cabbage game
     def is_valid(self):
-        state_set = self.key.get_target_set()
-        if "boat" not in state_set:
-            goat_on_shore = "goat" in state_set
-            wolf_on_shore = "wolf" in state_set
-            cabbage_on_shore = "cabbage" in state_set
-        else:
-            goat_on_shore = "goat" not in state_set
-            wolf_on_shore = "wolf" not in state_set
-            cabbage_on_shore = "cabbage" not in state_set
-
-        return not (goat_on_shore and wolf_on_shore) and not (goat_on_shore and cabbage_on_shore)        
+        return bool(GoatBridgeGameVertex.batch_is_valid(self.graph,self.get_target_mask()))
+
+    # The same check for a whole array of masks at once (see BridgeGameGraph.define_states)
+    # Find the shore without the boat, then test the forbidden pairs on it
+    @staticmethod
+    def batch_is_valid(graph,masks):
+        bits = graph.object_bits
+        unattended = graph.unattended_shore(masks)
+        goat_wolf = bits["goat"] | bits["wolf"]
+        goat_cabbage = bits["goat"] | bits["cabbage"]
+        return ((unattended & goat_wolf) != goat_wolf) & ((unattended & goat_cabbage) != goat_cabbage)
 
 class GoatBridgeGameGraph(BridgeGameGraph):
     BRIDGE_OBJ_LIST = ["goat","wolf","cabbage","boat"]
-    def __init__(self,mode):
+    def __init__(self,mode,compact_keys=False,incoming_edges=False,stats=None,deferred_edges=False):
         # The boat in the goat problem can only carry up to one passenger (the man is for the purposes of this puzzle a permanent fixture of the boat)
         # Up to: the boat can go empty too and indeed must
         self.arities = set([0,1])
         # For generating the vertices, we need to know which object is the carrier
         self.carrier = "boat"
 
-        super().__init__(GoatBridgeGameGraph.BRIDGE_OBJ_LIST,mode,state_class=GoatBridgeGameVertex)
+        super().__init__(GoatBridgeGameGraph.BRIDGE_OBJ_LIST,mode,state_class=GoatBridgeGameVertex,
+                         compact_keys=compact_keys,incoming_edges=incoming_edges,stats=stats,deferred_edges=deferred_edges)
 
 class CrossingAtNightEdge(BridgeGameEdge):
+    __slots__ = ("weight",)
+
     def __init__(self,src,dst,graph):
         super().__init__(src,dst,graph)
-        # The weight is assigned with the help of the graph
-        # According to the problem specification, the weight is the maximum of all the weights of the objects
-        # that crossed the river (obviously, in the same direction)
+        self.weight = CrossingAtNightEdge.transition_weight(src,dst,graph)
 
-        if len(self.moved_from_shore) > 0:
-            moved_set = self.moved_from_shore
-        elif len(self.moved_to_shore) > 0:
-            moved_set = self.moved_to_shore
+        #print("Constructing edge {} with weight {}".format(self.key,self.weight))
+
+    # The weight is assigned with the help of the graph
+    # According to the problem specification, the weight is the maximum of all the weights of the objects
+    # that crossed the river (obviously, in the same direction, so they are the bits that differ between the two masks)
+    # Static, so that graphs with deferred_edges=True can weigh an edge without building it
+    @staticmethod
+    def transition_weight(src,dst,graph):
+        moved_mask = graph.key_to_mask(src.get_key()) ^ graph.key_to_mask(dst.get_key())
 
         max_weight = 0
-        for obj in moved_set:
+        for obj in graph.mask_to_names(moved_mask):
             cur_weight = graph.transit_weight(obj)
             if cur_weight > max_weight:
                 max_weight = cur_weight
+        return max_weight
 
-        self.weight = max_weight
-
-        self.set_name("{} (weight {})".format(self.get_name(),max_weight))
-
-        #print("Constructing edge {} with weight {}".format(self.key,self.weight))
+    def get_name(self):
+        return "{} (weight {})".format(super().get_name(),self.weight)
 
     def get_weight(self):
         return self.weight
 
 class CrossingAtNightGraph(BridgeGameGraph):
     CROSSING_OBJ_LIST = ["flashlight", "oner", "twoer", "fiver", "tener"]
-    def __init__(self):
+    def __init__(self,mode="eager",compact_keys=False,incoming_edges=False,stats=None,deferred_edges=False):
         # NOTE: The flashlight cannot return alone, someone must bring it back
         self.arities = set([1,2])
         self.carrier = "flashlight"
@@ -275,16 +337,219 @@ class CrossingAtNightGraph(BridgeGameGraph):
                         "fiver" : 5,
                         "tener" : 10}
         
-        super().__init__(CrossingAtNightGraph.CROSSING_OBJ_LIST,"eager",trans_class=CrossingAtNightEdge)
+        super().__init__(CrossingAtNightGraph.CROSSING_OBJ_LIST,mode,trans_class=CrossingAtNightEdge,
+                         compact_keys=compact_keys,incoming_edges=incoming_edges,stats=stats,deferred_edges=deferred_edges)
 
     def transit_weight(self,obj):
         return self.transit_weights[obj]
 
+# Heuristics for gamegraph.astar_solve on crossing puzzles: any BridgeGameGraph with a transit_weight() function and
+# CrossingAtNightEdge transitions, where the destination is "all objects on the destination shore"
+# Both return a lower bound on the cost still to be paid from the given vertex
+
+def crossing_max_weight_heuristic(vertex):
+    # Everyone still on the origin shore must cross at least once, at a cost no smaller than their own weight
+    graph = vertex.graph
+    origin_mask = ~vertex.get_target_mask() & graph.full_mask
+    return max((graph.transit_weight(obj) for obj in graph.mask_to_names(origin_mask)),default=0)
+
+def crossing_trips_heuristic(vertex):
+    graph = vertex.graph
+    carrier = graph.carrier
+    dest_mask = vertex.get_target_mask()
+    origin_weights = [graph.transit_weight(obj) for obj in graph.mask_to_names(~dest_mask & graph.full_mask) if obj != carrier]
+    if not origin_weights:
+        return 0
+    origin_weights.sort(reverse=True)
+
+    # The last crossings of the objects on the origin shore take them over in groups of at most "capacity"
+    # With the weights sorted, no grouping costs less than every capacity-th weight starting from the heaviest
+    capacity = max(graph.arities)
+    if capacity == 0:
+        # Only the carrier ever crosses, so there is no grouping to count
+        return crossing_max_weight_heuristic(vertex)
+    estimate = sum(origin_weights[::capacity])
+
+    # Before every forward trip but the first (or every one, if the carrier is on the destination shore)
+    # someone must bring the carrier back
+    forward_trips = (len(origin_weights) + capacity - 1) // capacity
+    return_trips = forward_trips if dest_mask & graph.object_bits[carrier] else forward_trips - 1
+    if 0 in graph.arities:
+        return_weight = graph.transit_weight(carrier)
+    else:
+        return_weight = min(graph.transit_weight(obj) for obj in graph.sorted_objects if obj != carrier)
+
+    return estimate + return_trips * return_weight
+
+# Change the transit weight of an object in such a graph, and build again the edges in which it crosses
+# Returns the (removed_edges, added_edges) tuple of GameGraph.refresh_edges
+def change_transit_weight(graph,obj,weight):
+    graph.transit_weights[obj] = weight
+    obj_bit = graph.object_bits[obj]
+    changed_edges = list()
+    for key,vertex in graph.iterate_states():
+        if vertex.has_edges:
+            src_mask = graph.key_to_mask(key)
+            changed_edges.extend(edge for edge in vertex.edges_out if (src_mask ^ graph.key_to_mask(edge.get_dst_key())) & obj_bit)
+    return graph.refresh_edges(changed_edges)
+
+
+# Bridge games with interchangeable objects (several identical sheep, missionaries and cannibals, ...)
+# Objects are declared in equivalence classes, given as a dictionary from class name to the number of objects in it.
+# A state key is then the canonical form of all equivalent states: a tuple with the number of objects of each class
+# (in sorted order of class names) on the destination shore.  This gives prod(size+1) states instead of 2^n
+# The carrier must be a class of its own, of size 1
+
+def gen_count_splits(available,total):
+    # Generate every tuple of counts, each at most the corresponding count in "available", which sums to "total"
+    if not available:
+        if total == 0:
+            yield ()
+        return
+    for first_count in range(0,min(available[0],total)+1):
+        for rest in gen_count_splits(available[1:],total-first_count):
+            yield (first_count,) + rest
+
+class SymmetricBridgeGameVertex(gamegraph.GameVertex):
+    __slots__ = ()
+
+    def __str__(self):
+        return self.graph.key_to_string(self.key)
+
+    def get_count(self,obj_class):
+        # The number of objects of the class on the destination shore
+        return self.key[self.graph.class_index[obj_class]]
+
+    def get_origin_count(self,obj_class):
+        return self.graph.class_sizes[obj_class] - self.get_count(obj_class)
+
+    # As in BridgeGameVertex, the carrier crosses with a number of objects given by the arities
+    # Here the choice is how many of each class cross, among those on the carrier's shore
+    def gen_outgoing_keys(self):
+        graph = self.graph
+        carrier_idx = graph.class_index[graph.carrier]
+        carrier_on_dest = self.key[carrier_idx] == 1
+        direction = -1 if carrier_on_dest else 1
+
+        available = list()
+        for idx,obj_class in enumerate(graph.sorted_classes):
+            if idx == carrier_idx:
+                available.append(0)
+            elif carrier_on_dest:
+                available.append(self.key[idx])
+            else:
+                available.append(graph.class_sizes[obj_class] - self.key[idx])
+
+        for arity in sorted(graph.arities):
+            for moved_counts in gen_count_splits(available,arity):
+                new_key = [count + direction * moved for count,moved in zip(self.key,moved_counts)]
+                new_key[carrier_idx] += direction
+                yield tuple(new_key)
+
+    def gen_incoming_keys(self):
+        # Crossings can be undone, as for BridgeGameVertex
+        return self.gen_outgoing_keys()
+
+class SymmetricBridgeGameEdge(gamegraph.GameEdge):
+    __slots__ = ("moved_to_shore","moved_from_shore")
+
+    def __init__(self,src,dst,graph):
+        # The name lists how many objects of each class moved, in the style of BridgeGameEdge
+        src_key = src.get_key()
+        dst_key = dst.get_key()
+        self.moved_to_shore = dict()
+        self.moved_from_shore = dict()
+        for obj_class,src_count,dst_count in zip(graph.sorted_classes,src_key,dst_key):
+            if dst_count > src_count:
+                self.moved_to_shore[obj_class] = dst_count - src_count
+            elif src_count > dst_count:
+                self.moved_from_shore[obj_class] = src_count - dst_count
+
+        my_name = ""
+        if self.moved_to_shore:
+            my_name += "moved to destination: " + graph.counts_to_string(self.moved_to_shore)
+        if self.moved_from_shore:
+            my_name += "moved to origin: " + graph.counts_to_string(self.moved_from_shore)
+
+        super().__init__(src,dst,graph)
+        # The difference of the two keys identifies the edge among those of either vertex
+        super().set_key(tuple(dst_count - src_count for src_count,dst_count in zip(src_key,dst_key)))
+        super().set_name(my_name)
+
+class SymmetricBridgeGameGraph(gamegraph.GameGraph):
+    def __init__(self,object_classes,mode,state_class=SymmetricBridgeGameVertex,trans_class=SymmetricBridgeGameEdge,incoming_edges=False,stats=None,deferred_edges=False):
+        if object_classes.get(self.carrier) != 1:
+            raise RuntimeError("The carrier must be a class of one object")
+
+        self.sorted_classes = sorted(object_classes)
+        self.class_sizes = dict(object_classes)
+        self.class_index = {obj_class : idx for idx,obj_class in enumerate(self.sorted_classes)}
+
+        super().__init__(state_class,trans_class,mode,incoming_edges,stats,deferred_edges)
+
+    def make_key(self,counts):
+        # Build a key from a dictionary giving the number of objects of each class on the destination shore
+        # Classes which are not in the dictionary have no objects there
+        return tuple(counts.get(obj_class,0) for obj_class in self.sorted_classes)
+
+    def all_on_destination_key(self):
+        return self.make_key(self.class_sizes)
+
+    def counts_to_string(self,counts):
+        # Classes of one object are shown by name, others as "name x count"
+        my_string = ""
+        for obj_class in self.sorted_classes:
+            count = counts.get(obj_class,0)
+            if count == 1 and self.class_sizes[obj_class] == 1:
+                my_string += "{}, ".format(obj_class)
+            elif count > 0:
+                my_string += "{} x{}, ".format(obj_class,count)
+        return my_string
+
+    def key_to_string(self,key):
+        return self.counts_to_string(dict(zip(self.sorted_classes,key)))
+
+    # Keys as integers for external_bfs_solve: the counts are the digits of a number, in base (class size + 1)
+    def key_to_int(self,key):
+        value = 0
+        for obj_class,count in zip(self.sorted_classes,key):
+            value = value * (self.class_sizes[obj_class] + 1) + count
+        return value
+
+    def int_to_key(self,value):
+        counts = list()
+        for obj_class in reversed(self.sorted_classes):
+            value, count = divmod(value,self.class_sizes[obj_class] + 1)
+            counts.append(count)
+        return tuple(reversed(counts))
+
+    def gen_all_keys(self):
+        # Every combination of counts
+        return itertools.product(*(range(0,self.class_sizes[obj_class]+1) for obj_class in self.sorted_classes))
+
+class MissionariesGameVertex(SymmetricBridgeGameVertex):
+    __slots__ = ()
+
+    # On either shore, the missionaries (if any) must not be outnumbered by the cannibals
+    def is_valid(self):
+        for missionaries,cannibals in ((self.get_count("missionary"),self.get_count("cannibal")),
+                                       (self.get_origin_count("missionary"),self.get_origin_count("cannibal"))):
+            if missionaries > 0 and cannibals > missionaries:
+                return False
+        return True
+
+class MissionariesGameGraph(SymmetricBridgeGameGraph):
+    def __init__(self,mode,missionaries=3,cannibals=3,boat_capacity=2,incoming_edges=False,stats=None,deferred_edges=False):
+        # The boat needs at least one person to row it
+        self.arities = set(range(1,boat_capacity+1))
+        self.carrier = "boat"
+        super().__init__({"missionary" : missionaries, "cannibal" : cannibals, "boat" : 1},mode,
+                         state_class=MissionariesGameVertex,incoming_edges=incoming_edges,stats=stats,deferred_edges=deferred_edges)
 
 if __name__=="__main__":
-    ggraph = GoatBridgeGameGraph("lazy")
-    origin_key = BridgeGameKey(ggraph,set());
-    destination_key = BridgeGameKey(ggraph,set(GoatBridgeGameGraph.BRIDGE_OBJ_LIST))
+    ggraph = GoatBridgeGameGraph("lazy",compact_keys=True)
+    origin_key = ggraph.make_key(set())
+    destination_key = ggraph.make_key(GoatBridgeGameGraph.BRIDGE_OBJ_LIST)
     shortest_path = gamegraph.bfs_solve(ggraph, origin_key, destination_key)
     print("shortest path:")
     for edge_num, path_edge in enumerate(shortest_path):
@@ -311,5 +576,17 @@ if __name__=="__main__":
     for edge_num, path_edge in enumerate(shortest_path):
         print("{}. {}".format(edge_num+1,str(path_edge)))
 
+    # The same problem with A*, building the graph lazily
+    lazy_night_graph = CrossingAtNightGraph("lazy")
+    shortest_path = gamegraph.astar_solve(lazy_night_graph,lazy_night_graph.make_key(set()),
+                                          lazy_night_graph.make_key(CrossingAtNightGraph.CROSSING_OBJ_LIST),crossing_trips_heuristic)
+    print("shortest path (night crossing, A*):")
+    for edge_num, path_edge in enumerate(shortest_path):
+        print("{}. {}".format(edge_num+1,str(path_edge)))
 
-
+    # Missionaries and cannibals: identical people are interchangeable, so only their numbers are tracked
+    mc_graph = MissionariesGameGraph("lazy")
+    shortest_path = gamegraph.bfs_solve(mc_graph,mc_graph.make_key(dict()),mc_graph.all_on_destination_key())
+    print("shortest path (missionaries and cannibals):")
+    for edge_num, path_edge in enumerate(shortest_path):
+        print("{}. {}".format(edge_num+1,str(path_edge)))
@@ -1,7 +1,33 @@
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import cProfile
+import hashlib
+import heapq
 import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import pickle
+import pstats
 import queue
-
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import weakref
+
+# GameEdge and GameVertex use __slots__ to save memory on large graphs.  Derived classes should declare
+# __slots__ too (listing any attributes they add), otherwise their instances get a __dict__ again
 class GameEdge(object):
+    __slots__ = ("src_key","dest_key","graph","key","name")
+
     def __init__(self,src,dest,graph):
         self.src_key = src.get_key()
         self.dest_key = dest.get_key()
@@ -17,7 +43,7 @@ class GameEdge(object):
         return self.key
 
     def __str__(self):
-        return self.name
+        return self.get_name()
 
     def get_name(self):
         return self.name
@@ -31,10 +57,71 @@ class GameEdge(object):
     def is_valid(self):
         return True
 
+# In a graph with deferred_edges=True, the adjacency lists hold DeferredEdge objects instead of instances of the
+# edge class.  They have only the two keys and, if the edge class has get_weight(), the weight -- about the size of a
+# tuple -- so the searches use them as they are.  materialize() builds the real edge (once); the solvers do this for
+# the edges of the paths they return (see real_edge), so those behave as usual while the others are never built
+# get_key(), get_name() and str() also work on a DeferredEdge, through the real edge.
+# NOTE: there is deliberately no __getattr__ forwarding the other attributes: a class with __getattr__ makes every
+# attribute lookup on its instances slower, and the searches look up get_dst_key() on every edge
+class DeferredEdge(object):
+    __slots__ = ("src_key","dest_key","graph","edge")
+
+    # Tells edge_weight() and CompiledGraph that there is no weight, without building the edge
+    get_weight = None
+
+    def __init__(self,src_key,dest_key,graph):
+        self.src_key = src_key
+        self.dest_key = dest_key
+        self.graph = graph
+        self.edge = None
+
+    def get_src_key(self):
+        return self.src_key
+
+    def get_dst_key(self):
+        return self.dest_key
+
+    def is_valid(self):
+        return True # checked by GameGraph.make_edge()
+
+    def materialize(self):
+        # The edge, as an instance of the graph's edge class
+        if self.edge is None:
+            graph = self.graph
+            self.edge = graph.trans_class(graph.find_state(self.src_key),graph.find_state(self.dest_key),graph)
+        return self.edge
+
+    def get_key(self):
+        return self.materialize().get_key()
+
+    def get_name(self):
+        return self.materialize().get_name()
+
+    def __str__(self):
+        return str(self.materialize())
+
+class DeferredWeightedEdge(DeferredEdge):
+    __slots__ = ("weight",)
+
+    def __init__(self,src_key,dest_key,graph,weight):
+        super().__init__(src_key,dest_key,graph)
+        self.weight = weight
+
+    def get_weight(self):
+        return self.weight
+
+# The edge itself, for edges which may be DeferredEdge objects
+def real_edge(edge):
+    return edge.materialize() if isinstance(edge,DeferredEdge) else edge
+
 class GameVertex(object):
+    __slots__ = ("edges_in","edges_out","key","has_edges","graph")
+
     def __init__(self,key,graph):
-        self.edges_in = dict()
-        self.edges_out = dict()
+        # Edges are kept in lists.  Incoming edges are only kept if the graph was created with incoming_edges=True
+        self.edges_in = list() if graph.incoming_edges else None
+        self.edges_out = list()
         self.key = key
         self.has_edges = False
         self.graph = graph
@@ -61,36 +148,165 @@ class GameVertex(object):
         else:
             raise RuntimeError("Cannot add unrelated edge")
 
-        target_dict = self.edges_out if is_from_me else self.edges_in
-
-        edge_key = edge.get_key()
-        if edge_key in target_dict:
-            raise RuntimeError("Edge {} has the same key as another edge in vertex {}".format(str(edge), str(self)))
-
-        target_dict[edge_key] = edge
+        # NOTE: edge keys are checked for duplicates in GameGraph.link() (or once per vertex in link_transitions()), not here
+        if is_from_me:
+            self.edges_out.append(edge)
+        elif self.edges_in is not None:
+            self.edges_in.append(edge)
 
     def iter_to(self):
+        if self.edges_in is None:
+            raise RuntimeError("Incoming edges are not kept -- create the graph with incoming_edges=True")
         if not self.has_edges:
             raise RuntimeError("Iterating before edges are created -- call iter_from() first")
-        return map(lambda p: p[1],self.edges_in.items())
+        return iter(self.edges_in)
 
     def iter_from(self):
         if not self.has_edges:
             # Need to create edges before i can iterate
             self.graph.add_transitions(self)
-        return map(lambda p: p[1],self.edges_out.items())
+        return iter(self.edges_out)
+
+    def iter_incoming(self):
+        # Incoming edges for backward searches.  In eager mode with incoming edges kept, this is iter_to().
+        # Otherwise (and always in lazy mode, where the incoming edges of a state are not known until all its
+        # predecessors are expanded) the vertex class must implement gen_incoming_keys(), generating the keys of
+        # all states which may have an edge to this one
+        # A graph built with build_reachable() has all the edges between its states, like an eager graph
+        graph = self.graph
+        if graph.incoming_edges and (graph.mode == "eager" or graph.reachable_source is not None):
+            return self.iter_to()
+        if not hasattr(self,"gen_incoming_keys"):
+            raise RuntimeError("Backward search requires incoming_edges=True (eager mode) or gen_incoming_keys() on the vertex class")
+        return self.gen_incoming_edges()
+
+    def gen_incoming_edges(self):
+        # Only the edge from each predecessor to this state is built: expanding the predecessors would create all
+        # their successors, which is what a backward search in lazy mode is meant to avoid
+        graph = self.graph
+        my_key = self.get_key()
+        pred_keys = set()
+        for pred_key in self.gen_incoming_keys():
+            if pred_key in pred_keys:
+                continue
+            pred_keys.add(pred_key)
+            pred_state = graph.create_state(pred_key)
+            if pred_state is None:
+                continue
+            if pred_state.has_edges:
+                for edge in pred_state.edges_out:
+                    if edge.get_dst_key() == my_key:
+                        yield edge
+            elif my_key in pred_state.gen_outgoing_keys():
+                # A candidate predecessor, which does have a transition to this state
+                edge = graph.make_edge(pred_state,self)
+                if edge is not None:
+                    yield edge
 
     def __iter__(self):
+        if self.edges_in is None:
+            return self.iter_from()
         return itertools.chain(self.iter_from(),self.iter_to())
                                                             
 
-class GameGraph(object):
+# GraphStats collects counters and timings for a graph and the searches run on it (see GameGraph.enable_stats)
+# . states_created, states_invalid: vertices added to the graph, and vertices rejected by is_valid()
+# . edges_created, edges_invalid: edges linked into the graph, and edges rejected by is_valid()
+# . vertices_expanded: vertices whose outgoing (or incoming) edges were followed by a search
+# . max_frontier: the largest queue, heap or stack size seen by a search
+# "times" holds the cumulative seconds spent in each user callback (gen_outgoing_keys, state_init, state_is_valid,
+# edge_init, edge_is_valid, batch_is_valid) and in each search function, which includes the callbacks it triggers
+class GraphStats(object):
+    COUNTERS = ("states_created","states_invalid","edges_created","edges_invalid","vertices_expanded","max_frontier")
+
+    def __init__(self):
+        self.profiler = None
+        self.reset()
+
+    def reset(self):
+        for counter in GraphStats.COUNTERS:
+            setattr(self,counter,0)
+        self.times = collections.defaultdict(float)
+
+    def as_dict(self):
+        result = {counter : getattr(self,counter) for counter in GraphStats.COUNTERS}
+        result["times"] = dict(self.times)
+        return result
+
+    def note_frontier(self,size):
+        if size > self.max_frontier:
+            self.max_frontier = size
+
+    def timed_call(self,name,func,*args):
+        start_time = time.perf_counter()
+        result = func(*args)
+        self.times[name] += time.perf_counter() - start_time
+        return result
+
+    def timed_iter(self,name,iterator):
+        # Time each step of an iterator (such as the generator returned by gen_outgoing_keys) separately, so that
+        # the time spent by the consumer between steps is not counted
+        iterator = iter(iterator)
+        times = self.times
+        while True:
+            start_time = time.perf_counter()
+            item = next(iterator,StopIteration)
+            times[name] += time.perf_counter() - start_time
+            if item is StopIteration:
+                return
+            yield item
+
+    @contextlib.contextmanager
+    def phase(self,name):
+        # Time a block of code:  with stats.phase("setup"): ...
+        start_time = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.times[name] += time.perf_counter() - start_time
+
+    @contextlib.contextmanager
+    def profile(self):
+        # Run a block of code under cProfile.  The profiler is kept in self.profiler (see profile_stats).
+        # Callbacks of an instrumented graph are called through timed_call() and timed_iter(), so the profile can
+        # also be restricted to them with pstats' print_callees()
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        try:
+            yield self.profiler
+        finally:
+            self.profiler.disable()
+
+    def profile_stats(self,sort_key="cumulative"):
+        if self.profiler is None:
+            raise RuntimeError("Nothing profiled yet -- use GraphStats.profile()")
+        return pstats.Stats(self.profiler).sort_stats(sort_key)
 
-    def __init__(self,state_class,trans_class,mode):
+class GameGraph(object):
+    # Instance attributes which are not parameters of the puzzle, and are left out of fingerprint()
+    FINGERPRINT_EXCLUDE = ("graph","mode","reachable_source","mutation_count","edit_count","incoming_edges","stats","deferred_edges")
+
+    # If incoming_edges is true, every vertex also keeps its incoming edges, for iter_to()
+    # If stats is a GraphStats object, the graph and the searches on it update it (see enable_stats); pass it here to
+    # measure the construction of an eager graph
+    # If deferred_edges is true, the edges are DeferredEdge objects, and the edge class is only instantiated for edges
+    # which are used for more than their keys and weight (see make_edge)
+    def __init__(self,state_class,trans_class,mode,incoming_edges=False,stats=None,deferred_edges=False):
         self.graph = dict()
         self.state_class = state_class
         self.trans_class = trans_class
         self.mode = mode
+        self.incoming_edges = incoming_edges
+        self.stats = stats
+        self.deferred_edges = deferred_edges
+        # Set by build_reachable()
+        self.reachable_source = None
+        # Incremented by add_state() and link(), so that cached results can tell when the graph has changed
+        self.mutation_count = 0
+        # Incremented by unlink() and remove_state(): a graph which has never been edited has the same states and edges
+        # as any other graph with the same fingerprint (as far as it has been built)
+        self.edit_count = 0
 
         if mode == "eager":
             # Create the vertices
@@ -98,8 +314,8 @@ class GameGraph(object):
             # Create the edges
             for key,vx in self.graph.items():
                 self.add_transitions(vx)
-        elif mode != "lazy":
-            raise RuntimeException("GameGraph mode must be 'eager' or 'lazy'")
+        elif mode != "lazy" and mode != "reachable":
+            raise RuntimeError("GameGraph mode must be 'eager', 'lazy' or 'reachable'")
 
     def define_states(self):
         # Generate all the keys
@@ -112,8 +328,13 @@ class GameGraph(object):
             
         # This function is used for the eager case.  All target vertices must exist
         # iterate through the outgoing keys of the vertex.  Create transitions to correspond to each key
-        src_key = source_state.get_key()
-        for dest_key in source_state.gen_outgoing_keys():
+        edges = list()
+        stats = self.stats
+        if stats is None:
+            dest_keys = source_state.gen_outgoing_keys()
+        else:
+            dest_keys = stats.timed_iter("gen_outgoing_keys",source_state.gen_outgoing_keys())
+        for dest_key in dest_keys:
             if self.mode == "eager":
                 dest_state = self.find_state(dest_key)
             else: # Lazy.  Create the state now
@@ -122,14 +343,70 @@ class GameGraph(object):
             if dest_state is None:  # This is not an error -- invalid states are not created. Continue to the next key
                 continue
 
+            edge = self.make_edge(source_state,dest_state)
+            if edge is not None:
+                edges.append(edge)
+
+        self.link_transitions(source_state,edges)
+
+    def link_transitions(self,source_state,edges):
+        # Link the outgoing edges of a vertex, checking once for all of them that no two have the same key, and let the
+        # vertex know that its outgoing edges exist
+        out_keys = set(self.distinct_edge_key(edge) for edge in source_state.edges_out)
+        for edge in edges:
+            edge_key = self.distinct_edge_key(edge)
+            if edge_key in out_keys:
+                raise RuntimeError("Edge {} has the same key as another edge in vertex {}".format(str(edge), str(source_state)))
+            out_keys.add(edge_key)
+            self.link(edge,check_duplicate=False)
+        source_state.set_has_edges()
+
+    def make_edge(self,source_state,dest_state):
+        # The edge from source_state to dest_state, or None if the edge class rejects it
+        stats = self.stats
+        if self.deferred_edges:
+            return self.make_deferred_edge(source_state,dest_state)
+        if stats is None:
             edge = self.trans_class(source_state,dest_state,self)
+            return edge if edge.is_valid() else None
+
+        edge = stats.timed_call("edge_init",self.trans_class,source_state,dest_state,self)
+        if not stats.timed_call("edge_is_valid",edge.is_valid):
+            stats.edges_invalid += 1
+            return None
+        stats.edges_created += 1
+        return edge
+
+    def make_deferred_edge(self,source_state,dest_state):
+        is_valid, weight = self.check_transition(source_state,dest_state)
+        if not is_valid:
+            if self.stats is not None:
+                self.stats.edges_invalid += 1
+            return None
+        if self.stats is not None:
+            self.stats.edges_created += 1
+        return self.make_deferred_stub(source_state.get_key(),dest_state.get_key(),weight)
+
+    def check_transition(self,source_state,dest_state):
+        # Whether the edge class accepts the edge, and its weight (None if the edge class has no get_weight())
+        # The edge class is still instantiated (and the instance dropped) if it overrides is_valid(), or if it has
+        # get_weight() but no static transition_weight(src,dst,graph) to compute the weight without an instance
+        trans_class = self.trans_class
+        weighted = hasattr(trans_class,"get_weight")
+        transition_weight = getattr(trans_class,"transition_weight",None)
+        edge = None
+        if trans_class.is_valid is not GameEdge.is_valid or (weighted and transition_weight is None):
+            edge = trans_class(source_state,dest_state,self)
             if not edge.is_valid():
-                continue
-            
-            self.link(edge)
+                return False, None
+        if not weighted:
+            return True, None
+        return True, transition_weight(source_state,dest_state,self) if transition_weight is not None else edge.get_weight()
 
-        # Let the vertex know that its outgoing edges exist
-        source_state.set_has_edges()
+    def make_deferred_stub(self,src_key,dest_key,weight):
+        if weight is None:
+            return DeferredEdge(src_key,dest_key,self)
+        return DeferredWeightedEdge(src_key,dest_key,self,weight)
 
     def find_state(self,key):
         return self.graph.get(key)
@@ -141,9 +418,17 @@ class GameGraph(object):
 
         #print ("key {}; graph size before add {}".format(str(key),str(len(self.graph))))
         
-        vertex_obj = self.state_class(key,self)
-        if not vertex_obj.is_valid():
-            return None
+        stats = self.stats
+        if stats is None:
+            vertex_obj = self.state_class(key,self)
+            if not vertex_obj.is_valid():
+                return None
+        else:
+            vertex_obj = stats.timed_call("state_init",self.state_class,key,self)
+            if not stats.timed_call("state_is_valid",vertex_obj.is_valid):
+                stats.states_invalid += 1
+                return None
+            stats.states_created += 1
 
         # Add the state to the dictionary
         self.add_state(vertex_obj)
@@ -157,10 +442,18 @@ class GameGraph(object):
             raise RuntimeError("state with key {} already in graph".format(str(vx_key)))
 
         self.graph[vx_key] = vertex
+        self.mutation_count += 1
 
         #print ("cur states {}".format(self.graph))
 
-    def link(self,edge):
+    def distinct_edge_key(self,edge):
+        # The key which no two outgoing edges of a vertex may share
+        # Deferred edges have no key of their own; they are told apart by their destination
+        return edge.get_dst_key() if self.deferred_edges else edge.get_key()
+
+    # "check_duplicate" may be false only if the caller has already checked that no outgoing edge of the source has the
+    # same key (as link_transitions() does for all the edges of a vertex at once, instead of one scan per edge)
+    def link(self,edge,check_duplicate=True):
         source_key = edge.get_src_key()
         dest_key = edge.get_dst_key()
 
@@ -173,57 +466,844 @@ class GameGraph(object):
         source_vertex = self.graph[source_key]
         dest_vertex = self.graph[dest_key]
 
+        if check_duplicate:
+            edge_key = self.distinct_edge_key(edge)
+            for other_edge in source_vertex.edges_out:
+                if self.distinct_edge_key(other_edge) == edge_key:
+                    raise RuntimeError("Edge {} has the same key as another edge in vertex {}".format(str(edge), str(source_vertex)))
+
         source_vertex.add_edge(edge)
         dest_vertex.add_edge(edge)
+        self.mutation_count += 1
+
+    def unlink(self,edge):
+        # Undo link()
+        source_vertex = self.graph.get(edge.get_src_key())
+        if source_vertex is not None:
+            source_vertex.edges_out.remove(edge)
+        dest_vertex = self.graph.get(edge.get_dst_key())
+        if dest_vertex is not None and dest_vertex.edges_in is not None:
+            dest_vertex.edges_in.remove(edge)
+        self.mutation_count += 1
+        self.edit_count += 1
+
+    def find_incoming_edges(self,vertex):
+        # The existing edges into a vertex, without creating any states or edges
+        # Uses the incoming edges if they are kept, otherwise the predecessors given by gen_incoming_keys(), otherwise
+        # every state of the graph
+        if vertex.edges_in is not None:
+            return list(vertex.edges_in)
+        my_key = vertex.get_key()
+        if hasattr(vertex,"gen_incoming_keys"):
+            pred_vertices = [self.find_state(pred_key) for pred_key in set(vertex.gen_incoming_keys())]
+        else:
+            pred_vertices = [pred_vertex for pred_key,pred_vertex in self.iterate_states()]
+        incoming = list()
+        for pred_vertex in pred_vertices:
+            if pred_vertex is not None and pred_vertex.has_edges:
+                incoming.extend(edge for edge in pred_vertex.edges_out if edge.get_dst_key() == my_key)
+        return incoming
+
+    # Incremental changes
+    # After a change to the rules of the puzzle (a validity rule, a weight), the following functions bring the
+    # affected part of the graph up to date without rebuilding it.  Each returns a (removed_edges, added_edges) tuple,
+    # which can be passed to ShortestPathTree.repair()
+
+    def remove_state(self,key):
+        # Remove a state and all its edges
+        vertex = self.graph.get(key)
+        if vertex is None:
+            return list(), list()
+        removed_edges = self.find_incoming_edges(vertex)
+        if vertex.has_edges:
+            removed_edges.extend(edge for edge in vertex.edges_out if edge.get_dst_key() != key)
+        for edge in removed_edges:
+            self.unlink(edge)
+        del self.graph[key]
+        self.mutation_count += 1
+        self.edit_count += 1
+        return removed_edges, list()
+
+    def invalidate_states(self,keys):
+        # Remove the given states, whether or not they are still valid
+        removed_edges = list()
+        for key in keys:
+            removed_edges.extend(self.remove_state(key)[0])
+        return removed_edges, list()
+
+    def revalidate_states(self,keys):
+        # Check is_valid() again for the given keys: states which are no longer valid are removed, and states which
+        # have become valid are added, with their edges from the states which already have their outgoing edges.  In
+        # eager mode the new states get their outgoing edges at once; otherwise they get them on demand, as usual
+        removed_edges = list()
+        added_edges = list()
+        for key in keys:
+            vertex = self.find_state(key)
+            if vertex is not None:
+                if not vertex.is_valid():
+                    removed_edges.extend(self.remove_state(key)[0])
+                continue
+
+            vertex = self.create_state(key)
+            if vertex is None:
+                continue
+            if hasattr(vertex,"gen_incoming_keys"):
+                pred_vertices = [self.find_state(pred_key) for pred_key in set(vertex.gen_incoming_keys())]
+            else:
+                pred_vertices = [pred_vertex for pred_key,pred_vertex in self.iterate_states()]
+            for pred_vertex in pred_vertices:
+                if pred_vertex is None or not pred_vertex.has_edges or key not in set(pred_vertex.gen_outgoing_keys()):
+                    continue
+                edge = self.make_edge(pred_vertex,vertex)
+                if edge is not None:
+                    self.link(edge)
+                    added_edges.append(edge)
+            if self.mode == "eager":
+                self.add_transitions(vertex)
+                added_edges.extend(vertex.edges_out)
+        return removed_edges, added_edges
+
+    def refresh_edges(self,edges):
+        # Build the given edges again (for instance after a weight has changed), dropping those no longer valid
+        removed_edges = list()
+        added_edges = list()
+        for old_edge in edges:
+            self.unlink(old_edge)
+            removed_edges.append(old_edge)
+            new_edge = self.make_edge(self.find_state(old_edge.get_src_key()),self.find_state(old_edge.get_dst_key()))
+            if new_edge is not None:
+                self.link(new_edge)
+                added_edges.append(new_edge)
+        return removed_edges, added_edges
 
     def iterate_states(self):
         return self.graph.items()
 
+    def enable_stats(self):
+        # Start collecting counters and timings in a new GraphStats object, which is returned
+        # Without it, the only cost of instrumentation is a check of self.stats in a few places
+        self.stats = GraphStats()
+        return self.stats
+
+    def disable_stats(self):
+        # Stop collecting, and return the GraphStats object (or None)
+        stats = self.stats
+        self.stats = None
+        return stats
+
+    def build_reachable(self,src,workers=None,chunk_size=256):
+        # In "reachable" mode, build every state reachable from src together with all its outgoing edges, one BFS level at a time
+        # If workers is more than 1, gen_outgoing_keys() and the validity checks of each level are spread over a pool of
+        # that many processes, and the results are merged into the graph before the next level
+        # With deferred_edges, the workers also check the edges and compute their weights, so the main process only
+        # creates the states and links stubs.  Otherwise it still instantiates every edge, which is most of the work
+        # for cheap callbacks: then the workers only pay off if gen_outgoing_keys() or is_valid() is expensive
+        if self.mode != "reachable":
+            raise RuntimeError("build_reachable() requires a graph in 'reachable' mode")
+
+        src_vertex = self.create_state(src)
+        if src_vertex is None:
+            raise RuntimeError("source state key invalid")
+        self.reachable_source = src
+
+        frontier = [src_vertex] if not src_vertex.has_edges else list()
+        if workers is None or workers <= 1:
+            while frontier:
+                next_frontier = dict()
+                for vertex in frontier:
+                    for edge in vertex.iter_from():
+                        dest_key = edge.get_dst_key()
+                        dest_vertex = self.find_state(dest_key)
+                        if not dest_vertex.has_edges:
+                            next_frontier[dest_key] = dest_vertex
+                frontier = list(next_frontier.values())
+            return
+
+        with concurrent.futures.ProcessPoolExecutor(workers,initializer=init_worker_graph,initargs=(self.worker_copy(),)) as pool:
+            level = 0
+            while frontier:
+                key_chunks = list()
+                for chunk_start in range(0,len(frontier),chunk_size):
+                    key_chunks.append([vertex.get_key() for vertex in frontier[chunk_start:chunk_start+chunk_size]])
+
+                next_frontier = list()
+                # The callbacks run in the workers are not timed, but the states and edges are counted
+                stats = self.stats
+                for chunk_result in pool.map(expand_keys_in_worker,itertools.repeat(level),key_chunks):
+                    for src_key, transitions in chunk_result:
+                        source_state = self.find_state(self.adopt_key(src_key))
+                        edges = list()
+                        for dest_key, weight in transitions:
+                            dest_key = self.adopt_key(dest_key)
+                            dest_state = self.find_state(dest_key)
+                            if dest_state is None:
+                                # The worker has already checked that the state is valid
+                                dest_state = self.state_class(dest_key,self)
+                                self.add_state(dest_state)
+                                next_frontier.append(dest_state)
+                                if stats is not None:
+                                    stats.states_created += 1
+
+                            if self.deferred_edges:
+                                # ... and the edge
+                                edges.append(self.make_deferred_stub(source_state.get_key(),dest_key,weight))
+                                if stats is not None:
+                                    stats.edges_created += 1
+                            else:
+                                edge = self.make_edge(source_state,dest_state)
+                                if edge is not None:
+                                    edges.append(edge)
+                        self.link_transitions(source_state,edges)
+                frontier = next_frontier
+                level += 1
+
+    def adopt_key(self,key):
+        # Called on keys which come back from worker processes.  Derived classes whose keys refer to the graph
+        # should make them refer to this one
+        return key
+
+    def key_to_int(self,key):
+        # Encode a state key as an integer in 0..2^63-1, for searches which keep their keys in files (external_bfs_solve)
+        # Derived classes whose keys are not such integers must override this and int_to_key()
+        if not isinstance(key,int) or key < 0 or key >= 1 << 63:
+            raise RuntimeError("State key {} is not a 63-bit integer -- override key_to_int() and int_to_key()".format(key))
+        return key
+
+    def int_to_key(self,value):
+        return value
+
+    def worker_copy(self):
+        # A copy of the graph without its states, to be sent to worker processes
+        graph_copy = copy.copy(self)
+        graph_copy.graph = dict()
+        graph_copy.stats = None
+        return graph_copy
+
+    def compile(self,weighted=None):
+        # Freeze the current graph into a CompiledGraph (see below).  Every vertex must already have its edges,
+        # which is always the case in eager mode
+        # If weighted is None, weights are stored when the edges have a get_weight() method
+        return CompiledGraph(self,weighted)
+
+    def fingerprint(self):
+        # A digest of the graph's class and parameters (its instance attributes, other than the states themselves)
+        # Used to check that a saved graph was built for the same puzzle (see CompiledGraph.save)
+        # NOTE: changes to the code of the derived classes are not detected
+        params = {name : value for name,value in vars(self).items() if name not in self.FINGERPRINT_EXCLUDE}
+        fingerprint_text = canonical_repr(type(self)) + canonical_repr(params)
+        return hashlib.sha256(fingerprint_text.encode("utf-8")).hexdigest()
+
+    def find_edge(self,src_key,dst_key):
+        # Find the edge between two states, creating the source state and its edges if needed (in lazy mode)
+        src_state = self.create_state(src_key)
+        if src_state is None:
+            return None
+        for edge in src_state.iter_from():
+            if edge.get_dst_key() == dst_key:
+                return edge
+        return None
+
+# A string representation which does not depend on the order of sets and dictionaries
+def canonical_repr(value):
+    if isinstance(value,dict):
+        return "{" + ",".join(sorted(canonical_repr(k) + ":" + canonical_repr(v) for k,v in value.items())) + "}"
+    elif isinstance(value,(set,frozenset)):
+        return "{" + ",".join(sorted(canonical_repr(v) for v in value)) + "}"
+    elif isinstance(value,(list,tuple)):
+        return "[" + ",".join(canonical_repr(v) for v in value) + "]"
+    elif isinstance(value,type):
+        return value.__module__ + "." + value.__qualname__
+    return repr(value)
+
+# Worker process side of GameGraph.build_reachable()
+# Each worker holds a copy of the graph without its states, and computes the valid transitions for chunks of keys:
+# (dest_key, weight) pairs, where the weight is only known (and the edge only checked) with deferred_edges
+# The destination states made for the validity checks are cached for the current BFS level only
+worker_graph = None
+worker_state_cache = dict()
+worker_cache_level = None
+
+def init_worker_graph(graph):
+    global worker_graph, worker_cache_level
+    worker_graph = graph
+    worker_state_cache.clear()
+    worker_cache_level = None
+
+def expand_keys_in_worker(level,keys):
+    global worker_cache_level
+    if level != worker_cache_level:
+        worker_state_cache.clear()
+        worker_cache_level = level
+    graph = worker_graph
+    state_class = graph.state_class
+    results = list()
+    for key in keys:
+        vertex = state_class(key,graph)
+        transitions = list()
+        for dest_key in vertex.gen_outgoing_keys():
+            if dest_key in worker_state_cache:
+                dest_state = worker_state_cache[dest_key]
+            else:
+                dest_state = state_class(dest_key,graph)
+                if not dest_state.is_valid():
+                    dest_state = None
+                worker_state_cache[dest_key] = dest_state
+            if dest_state is None:
+                continue
+            if graph.deferred_edges:
+                is_valid, weight = graph.check_transition(vertex,dest_state)
+                if is_valid:
+                    transitions.append((dest_key,weight))
+            else:
+                transitions.append((dest_key,None))
+        results.append((key,transitions))
+    return results
+
+# A CompiledGraph is a read-only snapshot of a GameGraph in compressed sparse row form
+# Vertices are numbered 0..N-1.  The outgoing edges of vertex i are at positions offsets[i] to offsets[i+1]-1
+# of the targets array (and of the weights array, if there is one).  The edges list holds the original GameEdge objects
+# at the same positions, so that solutions can be given in the usual form
+class CompiledGraph(object):
+    def __init__(self,graph,weighted=None):
+        self.graph = graph
+        self.keys = list()
+        self.ids = dict()
+        for key,vx in graph.iterate_states():
+            if not vx.has_edges:
+                raise RuntimeError("Cannot compile state {} before its edges are created".format(str(key)))
+            self.ids[key] = len(self.keys)
+            self.keys.append(key)
+
+        self.offsets = array.array("q",[0])
+        self.targets = array.array("q")
+        self.edges = list()
+        for key in self.keys:
+            for edge in graph.find_state(key).iter_from():
+                self.targets.append(self.ids[edge.get_dst_key()])
+                self.edges.append(edge)
+            self.offsets.append(len(self.targets))
+
+        if weighted is None:
+            weighted = len(self.edges) > 0 and getattr(self.edges[0],"get_weight",None) is not None
+        self.weights = array.array("d",(edge.get_weight() for edge in self.edges)) if weighted else None
+
+    def num_states(self):
+        return len(self.keys)
+
+    def get_id(self,key):
+        return self.ids.get(key)
+
+    def get_key(self,state_id):
+        return self.keys[state_id]
+
+    def get_edge(self,edge_idx):
+        return self.edges[edge_idx]
+
+    def edge_source(self,edge_idx):
+        # The vertex whose range of the targets array contains edge_idx
+        return bisect.bisect_right(self.offsets,edge_idx) - 1
+
+    def edge_path(self,parent_edge,src_id,dst_id):
+        # Follow the parent edge indices from dst back to src, and give the GameEdge objects in order
+        shortest_path = list()
+        cur_id = dst_id
+        while cur_id != src_id:
+            edge_idx = parent_edge[cur_id]
+            shortest_path.append(real_edge(self.get_edge(edge_idx)))
+            cur_id = self.edge_source(edge_idx)
+        return list(reversed(shortest_path))
+
+    def save(self,path,extra_sections=()):
+        # Write the graph to a file which MappedGraph can load without rebuilding it
+        # The file starts with GRAPH_FILE_MAGIC and the length of a JSON header, followed by the header and the arrays,
+        # each aligned to 8 bytes.  Integer keys are stored as an array, sorted for lookup; other keys are pickled
+        # extra_sections is a list of (name, bytes) pairs stored after the graph (see MappedGraph.get_section)
+        num_states = self.num_states()
+        sections = [("offsets",self.offsets.tobytes()),("targets",self.targets.tobytes())]
+        if self.weights is not None:
+            sections.append(("weights",self.weights.tobytes()))
+
+        if all(type(key) is int and -2**63 <= key < 2**63 for key in self.keys):
+            key_format = "int"
+            sorted_ids = sorted(range(num_states),key=self.keys.__getitem__)
+            sections.append(("keys",array.array("q",self.keys).tobytes()))
+            sections.append(("sorted_keys",array.array("q",(self.keys[i] for i in sorted_ids)).tobytes()))
+            sections.append(("sorted_ids",array.array("q",sorted_ids).tobytes()))
+        else:
+            key_format = "pickle"
+            sections.append(("keys",pickle.dumps(self.keys)))
+        sections.extend(extra_sections)
+
+        header = {"fingerprint" : self.graph.fingerprint(),
+                  "byteorder" : sys.byteorder,
+                  "num_states" : num_states,
+                  "key_format" : key_format}
+        # The section offsets depend on the header length and vice versa, so repeat until the header fits
+        relative_positions = dict()
+        position = 0
+        for name,data in sections:
+            relative_positions[name] = position
+            position += align8(len(data))
+        data_start = 0
+        while True:
+            header["sections"] = {name : [data_start + relative_positions[name],len(data)] for name,data in sections}
+            header_bytes = json.dumps(header).encode("utf-8")
+            needed_start = align8(len(GRAPH_FILE_MAGIC) + 8 + len(header_bytes))
+            if needed_start <= data_start:
+                break
+            data_start = needed_start
+        header_bytes = header_bytes.ljust(data_start - len(GRAPH_FILE_MAGIC) - 8)
+
+        with open(path,"wb") as graph_file:
+            graph_file.write(GRAPH_FILE_MAGIC)
+            graph_file.write(struct.pack("<q",len(header_bytes)))
+            graph_file.write(header_bytes)
+            for name,data in sections:
+                graph_file.write(data)
+                graph_file.write(bytes(align8(len(data)) - len(data)))
+
+GRAPH_FILE_MAGIC = b"GAMEGRPH"
+
+def align8(length):
+    return (length + 7) & ~7
+
+# A MappedGraph is a CompiledGraph loaded from a file written by CompiledGraph.save()
+# The arrays are memory-mapped rather than read, so many processes can share one file at almost no startup cost
+# "graph" must be a graph of the same class, built with the same parameters -- normally in lazy mode, so that building it
+# costs nothing.  Its fingerprint must match the one in the file.  Edge objects are created through it only when a
+# path is returned
+class MappedGraph(CompiledGraph):
+    def __init__(self,path,graph):
+        self.graph = graph
+        self.edges = None
+        with open(path,"rb") as graph_file:
+            self.mmap = mmap.mmap(graph_file.fileno(),0,access=mmap.ACCESS_READ)
+
+        if self.mmap[:len(GRAPH_FILE_MAGIC)] != GRAPH_FILE_MAGIC:
+            raise RuntimeError("{} is not a saved game graph".format(path))
+        header_start = len(GRAPH_FILE_MAGIC) + 8
+        header_len = struct.unpack("<q",self.mmap[len(GRAPH_FILE_MAGIC):header_start])[0]
+        header = json.loads(self.mmap[header_start:header_start+header_len].decode("utf-8"))
+        if header["byteorder"] != sys.byteorder:
+            raise RuntimeError("{} was saved on a machine with a different byte order".format(path))
+        if header["fingerprint"] != graph.fingerprint():
+            raise RuntimeError("{} was saved from a different graph".format(path))
+
+        self.num_mapped_states = header["num_states"]
+        self.key_format = header["key_format"]
+        self.sections = header["sections"]
+        self.buffer = memoryview(self.mmap)
+
+        self.offsets = self.get_section("offsets","q")
+        self.targets = self.get_section("targets","q")
+        self.weights = self.get_section("weights","d")
+        if self.key_format == "int":
+            self.keys = self.get_section("keys","q")
+            self.sorted_keys = self.get_section("sorted_keys","q")
+            self.sorted_ids = self.get_section("sorted_ids","q")
+            self.ids = None
+        else:
+            start, length = self.sections["keys"]
+            self.keys = [graph.adopt_key(key) for key in pickle.loads(self.mmap[start:start+length])]
+            self.ids = {key : state_id for state_id,key in enumerate(self.keys)}
+
+    def num_states(self):
+        return self.num_mapped_states
+
+    def get_id(self,key):
+        if self.ids is not None:
+            return self.ids.get(key)
+        if type(key) is not int:
+            return None
+        pos = bisect.bisect_left(self.sorted_keys,key)
+        if pos < len(self.sorted_keys) and self.sorted_keys[pos] == key:
+            return self.sorted_ids[pos]
+        return None
+
+    def get_section(self,name,typecode):
+        # A section of the file as an array of the given type, or None if there is no such section
+        # Arrays taken from here must be released (or dropped) before close()
+        if name not in self.sections:
+            return None
+        start, length = self.sections[name]
+        return self.buffer[start:start+length].cast(typecode)
+
+    def get_edge(self,edge_idx):
+        return self.graph.find_edge(self.get_key(self.edge_source(edge_idx)),self.get_key(self.targets[edge_idx]))
+
+    def close(self):
+        # Release the arrays before closing the mapping
+        self.offsets = self.targets = self.weights = None
+        if self.key_format == "int":
+            self.keys = self.sorted_keys = self.sorted_ids = None
+        self.buffer.release()
+        self.mmap.close()
+
+# Goals
+# bfs_solve, dfs_solve and dijkstra accept as "dst" either a single key, a set (or frozenset) of keys, or a function
+# which takes a GameVertex and returns True for goal states.  make_goal_test turns any of these into such a function
+def make_goal_test(dst):
+    if dst is None:
+        return lambda vertex: False
+    elif callable(dst):
+        return dst
+    elif isinstance(dst,(set,frozenset)):
+        return lambda vertex: vertex.get_key() in dst
+    return lambda vertex: vertex.get_key() == dst
+
+def is_single_goal(dst):
+    return not callable(dst) and not isinstance(dst,(set,frozenset))
+
+# Results for all_goals=True: a dictionary from each goal key reached to a (distance, path) tuple
+def all_goals_result(tree,src,reached,path_cost):
+    result = dict()
+    for goal_key in reached:
+        path = path_from_tree(tree,src,goal_key)
+        result[goal_key] = (path_cost(path),path)
+    return result
+
+def weighted_path_cost(path):
+    cost = 0
+    for edge in path:
+        cost += edge.get_weight()
+    return cost
+
 # bfs_solve always finds the shortest path through an unweighted state graph for a puzzle
-def bfs_solve(graph,src,dst):
-    # Construct a BFS tree for all vertices and use it to give the shortest path to the solution state
+# The path leads to the nearest goal.  If "all_goals" is true, the search continues and the result is the
+# all_goals_result() for every goal reachable from src
+# If "bidirectional" is true, bidirectional_bfs_solve is used instead (single destination keys only)
+def bfs_solve(graph,src,dst,bidirectional=False,all_goals=False):
+    if bidirectional:
+        if all_goals or not is_single_goal(dst):
+            raise RuntimeError("bidirectional search needs a single destination key")
+        return bidirectional_bfs_solve(graph,src,dst)
+
+    bfs_tree, reached = bfs_build_tree(graph,src,dst,all_goals)
+    if all_goals:
+        return all_goals_result(bfs_tree,src,reached,len)
+    return path_from_tree(bfs_tree,src,reached[0]) if reached else list()
+
+# Construct a BFS tree, mapping each key to the edge which reaches it, until a goal is dequeued (see make_goal_test)
+# If all_goals is true or dst is None, the tree covers every state reachable from src (a set of goal keys
+# stops the search once all are reached)
+# Returns the tree and the list of goal keys reached
+def bfs_build_tree(graph,src,dst=None,all_goals=False):
+    goal_test = make_goal_test(dst)
+    goals_left = len(dst) if isinstance(dst,(set,frozenset)) else None
+    reached = list()
     bfs_tree = {src : None}
+    stats = graph.stats
+    if stats is not None:
+        start_time = time.perf_counter()
 
-    bfs_queue = queue.Queue()
+    # A plain deque: queue.Queue would lock on every put and get, and each search has its own queue anyway
+    bfs_queue = collections.deque()
 
     # "create_state" because in lazy mode the source may not exist yet
     src_vertex = graph.create_state(src)
     if not src_vertex:
         raise RuntimeError("source state key invalid")
 
-    bfs_queue.put(src_vertex)
+    bfs_queue.append(src_vertex)
 
-    found_state = False
-    while bfs_queue.qsize() > 0:
+    while bfs_queue:
         # Get the next queue element
-        cur_vertex = bfs_queue.get()
+        cur_vertex = bfs_queue.popleft()
         cur_key = cur_vertex.get_key()
 
-        if cur_key == dst:
-            # Found dst, break
-            found_state = True
-            break
+        if goal_test(cur_vertex):
+            reached.append(cur_key)
+            if not all_goals or len(reached) == goals_left:
+                # Found dst, break
+                break
 
         # Add all unvisited neighbors to the bfs queue
         for edge in cur_vertex.iter_from():
             neighbor_key = edge.get_dst_key()
             if neighbor_key not in bfs_tree:
                 bfs_tree[neighbor_key] = edge
-                bfs_queue.put(graph.find_state(neighbor_key))
-
+                bfs_queue.append(graph.find_state(neighbor_key))
+        if stats is not None:
+            stats.vertices_expanded += 1
+            stats.note_frontier(len(bfs_queue))
+
+    if stats is not None:
+        stats.times["bfs_build_tree"] += time.perf_counter() - start_time
+    return bfs_tree, reached
+
+# Given a tree mapping each key to the edge which reaches it, construct the path from src to dst as a list of edges
+# The list is empty if dst is not in the tree
+def path_from_tree(tree,src,dst):
     shortest_path = list()
-    if found_state:
-        # construct a shortest_path using edges
+    if dst in tree:
         cur_path_key = dst
         while cur_path_key != src:
-            cur_edge = bfs_tree[cur_path_key]
-            shortest_path.append(cur_edge)
+            cur_edge = tree[cur_path_key]
+            shortest_path.append(real_edge(cur_edge))
             cur_path_key = cur_edge.get_src_key()
           #  print("new cpk {}".format(cur_path_key))
-        return list(reversed(shortest_path))
+        shortest_path.reverse()
 
     return shortest_path
 
+# Grow the BFS tree "tree" by one level from "level", following forward or backward edges
+# Returns the next level and the best (length,key) meeting point with "other_dist", if any
+def bfs_expand_level(graph,level,tree,dist,other_dist,forward):
+    next_level = list()
+    best_meet = None
+    for cur_vertex in level:
+        cur_dist = dist[cur_vertex.get_key()]
+        edges = cur_vertex.iter_from() if forward else cur_vertex.iter_incoming()
+        for edge in edges:
+            neighbor_key = edge.get_dst_key() if forward else edge.get_src_key()
+            if neighbor_key not in tree:
+                tree[neighbor_key] = edge
+                dist[neighbor_key] = cur_dist + 1
+                next_level.append(graph.find_state(neighbor_key))
+                if neighbor_key in other_dist:
+                    length = cur_dist + 1 + other_dist[neighbor_key]
+                    if best_meet is None or length < best_meet[0]:
+                        best_meet = (length,neighbor_key)
+
+    stats = graph.stats
+    if stats is not None:
+        stats.vertices_expanded += len(level)
+        stats.note_frontier(len(next_level))
+    return next_level, best_meet
+
+# bidirectional_bfs_solve finds the same shortest path as bfs_solve by searching forward from the source and backward from the destination
+# one level at a time, always growing the smaller frontier, until the two searches meet
+# The backward search uses GameVertex.iter_incoming(), so lazy graphs need gen_incoming_keys() on the vertex class
+def bidirectional_bfs_solve(graph,src,dst):
+    src_vertex = graph.create_state(src)
+    if not src_vertex:
+        raise RuntimeError("source state key invalid")
+
+    dst_vertex = graph.create_state(dst)
+    if dst_vertex is None or src == dst:
+        return list()
+
+    stats = graph.stats
+    if stats is not None:
+        start_time = time.perf_counter()
+
+    # The forward tree stores the edge into each key, the backward tree the edge out of it toward dst
+    fwd_tree = {src : None}
+    bwd_tree = {dst : None}
+    fwd_dist = {src : 0}
+    bwd_dist = {dst : 0}
+    fwd_level = [src_vertex]
+    bwd_level = [dst_vertex]
+
+    best_meet = None
+    while fwd_level and bwd_level and best_meet is None:
+        if len(fwd_level) <= len(bwd_level):
+            fwd_level, best_meet = bfs_expand_level(graph,fwd_level,fwd_tree,fwd_dist,bwd_dist,True)
+        else:
+            bwd_level, best_meet = bfs_expand_level(graph,bwd_level,bwd_tree,bwd_dist,fwd_dist,False)
+
+    shortest_path = list()
+    if best_meet is not None:
+        meet_key = best_meet[1]
+        cur_path_key = meet_key
+        while cur_path_key != src:
+            cur_edge = fwd_tree[cur_path_key]
+            shortest_path.append(real_edge(cur_edge))
+            cur_path_key = cur_edge.get_src_key()
+        shortest_path.reverse()
+
+        cur_path_key = meet_key
+        while cur_path_key != dst:
+            cur_edge = bwd_tree[cur_path_key]
+            shortest_path.append(real_edge(cur_edge))
+            cur_path_key = cur_edge.get_dst_key()
+
+    if stats is not None:
+        stats.times["bidirectional_bfs_solve"] += time.perf_counter() - start_time
+    return shortest_path
+
+# External-memory BFS
+# Sorted files of 64-bit keys (see GameGraph.key_to_int), written and read with the "array" module
+def write_key_file(path,sorted_keys):
+    with open(path,"wb") as key_file:
+        block = array.array("q")
+        for key in sorted_keys:
+            block.append(key)
+            if len(block) >= EXTERNAL_BLOCK_KEYS:
+                block.tofile(key_file)
+                block = array.array("q")
+        block.tofile(key_file)
+
+def iter_key_file(path):
+    with open(path,"rb") as key_file:
+        while True:
+            block = array.array("q")
+            try:
+                block.fromfile(key_file,EXTERNAL_BLOCK_KEYS)
+            except EOFError:
+                pass # the keys that were there have been read
+            if not block:
+                return
+            yield from block
+
+def merge_unique_keys(sorted_iters):
+    last_key = None
+    for key in heapq.merge(*sorted_iters):
+        if key != last_key:
+            yield key
+            last_key = key
+
+def subtract_sorted_keys(sorted_keys,removed_keys):
+    # The keys of the first sorted iterator which are not in the second
+    removed_key = next(removed_keys,None)
+    for key in sorted_keys:
+        while removed_key is not None and removed_key < key:
+            removed_key = next(removed_keys,None)
+        if removed_key != key:
+            yield key
+
+def key_file_contains(path,key):
+    if os.path.getsize(path) == 0:
+        return False
+    with open(path,"rb") as key_file:
+        with mmap.mmap(key_file.fileno(),0,access=mmap.ACCESS_READ) as key_map:
+            keys = memoryview(key_map).cast("q")
+            try:
+                idx = bisect.bisect_left(keys,key)
+                return idx < len(keys) and keys[idx] == key
+            finally:
+                keys.release()
+
+EXTERNAL_BLOCK_KEYS = 1 << 16
+
+# external_bfs_solve finds the same shortest path as bfs_solve, with memory use that does not depend on the size of the
+# state space.  The search is level-synchronous: the keys of each BFS level are kept in a sorted file in work_dir
+# (a temporary directory by default, removed at the end).  The successors of a level are collected in memory up to
+# buffer_keys at a time, spilled to sorted files, merged, and freed of the keys of earlier levels by a sorted merge
+# with a file of all the keys seen so far.  If "undirected" is true (every transition can be undone, as in the bridge
+# games), only the two previous levels can hold the successors again, and the file of all keys is not needed
+# Vertices are created with the state class directly and are not added to the graph, except for the states of the
+# final path, which is rebuilt by walking backward through the level files (using gen_incoming_keys() if the vertex
+# class has it, otherwise by scanning the previous level).  Keys are stored with graph.key_to_int()
+# "dst" may be a key, a set of keys or a function of a vertex, as for bfs_solve
+def external_bfs_solve(graph,src,dst,work_dir=None,buffer_keys=1<<20,undirected=False):
+    goal_test = make_goal_test(dst)
+    state_class = graph.state_class
+    # Edges are only built if the edge class can reject them
+    check_edges = graph.trans_class.is_valid is not GameEdge.is_valid
+    stats = graph.stats
+    if stats is not None:
+        start_time = time.perf_counter()
+
+    src_vertex = state_class(src,graph)
+    if not src_vertex.is_valid():
+        raise RuntimeError("source state key invalid")
+    if goal_test(src_vertex):
+        return list()
+
+    temp_dir = None
+    if work_dir is None:
+        temp_dir = tempfile.mkdtemp(prefix="external_bfs")
+        work_dir = temp_dir
+
+    try:
+        level_paths = [os.path.join(work_dir,"level0.bin")]
+        write_key_file(level_paths[0],[graph.key_to_int(src)])
+        seen_path = level_paths[0]
+        goal_key = None
+
+        while goal_key is None:
+            depth = len(level_paths)
+            # Expand the last level, spilling sorted runs of successors
+            run_paths = list()
+            successors = set()
+            level_size = 0
+            for src_value in iter_key_file(level_paths[-1]):
+                level_size += 1
+                cur_vertex = state_class(graph.int_to_key(src_value),graph)
+                for dest_key in cur_vertex.gen_outgoing_keys():
+                    dest_vertex = state_class(dest_key,graph)
+                    if not dest_vertex.is_valid():
+                        continue
+                    if check_edges and not graph.trans_class(cur_vertex,dest_vertex,graph).is_valid():
+                        continue
+                    successors.add(graph.key_to_int(dest_key))
+                    if len(successors) >= buffer_keys:
+                        run_paths.append(os.path.join(work_dir,"run{}_{}.bin".format(depth,len(run_paths))))
+                        write_key_file(run_paths[-1],sorted(successors))
+                        successors.clear()
+            if stats is not None:
+                stats.vertices_expanded += level_size
+                stats.note_frontier(level_size)
+
+            # Merge the runs and drop the keys of earlier levels
+            new_keys = merge_unique_keys([iter_key_file(run_path) for run_path in run_paths] + [iter(sorted(successors))])
+            successors = None
+            if undirected:
+                for old_path in level_paths[-2:]:
+                    new_keys = subtract_sorted_keys(new_keys,iter_key_file(old_path))
+            else:
+                new_keys = subtract_sorted_keys(new_keys,iter_key_file(seen_path))
+
+            level_path = os.path.join(work_dir,"level{}.bin".format(depth))
+            level_count = 0
+            with open(level_path,"wb") as level_file:
+                block = array.array("q")
+                for key in new_keys:
+                    block.append(key)
+                    level_count += 1
+                    if goal_key is None and goal_test(state_class(graph.int_to_key(key),graph)):
+                        goal_key = key
+                    if len(block) >= EXTERNAL_BLOCK_KEYS:
+                        block.tofile(level_file)
+                        block = array.array("q")
+                block.tofile(level_file)
+            for run_path in run_paths:
+                os.remove(run_path)
+            level_paths.append(level_path)
+
+            if level_count == 0:
+                return list() # every reachable state has been seen
+
+            if not undirected:
+                new_seen_path = os.path.join(work_dir,"seen{}.bin".format(depth))
+                write_key_file(new_seen_path,merge_unique_keys([iter_key_file(seen_path),iter_key_file(level_path)]))
+                if seen_path != level_paths[0]:
+                    os.remove(seen_path)
+                seen_path = new_seen_path
+
+        # Walk backward: the predecessor of each state on the path is in the level before it
+        shortest_path = list()
+        cur_value = goal_key
+        for level_path in reversed(level_paths[:-1]):
+            cur_key = graph.int_to_key(cur_value)
+            path_edge = None
+            cur_vertex = state_class(cur_key,graph)
+            if hasattr(cur_vertex,"gen_incoming_keys"):
+                for pred_key in cur_vertex.gen_incoming_keys():
+                    if key_file_contains(level_path,graph.key_to_int(pred_key)):
+                        path_edge = graph.find_edge(pred_key,cur_key)
+                        if path_edge is not None:
+                            break
+            else:
+                for pred_value in iter_key_file(level_path):
+                    pred_key = graph.int_to_key(pred_value)
+                    if cur_key in state_class(pred_key,graph).gen_outgoing_keys():
+                        path_edge = graph.find_edge(pred_key,cur_key)
+                        if path_edge is not None:
+                            break
+            if path_edge is None:
+                raise RuntimeError("No predecessor of {} in the previous BFS level".format(cur_key))
+            shortest_path.append(real_edge(path_edge))
+            cur_value = graph.key_to_int(path_edge.get_src_key())
+        shortest_path.reverse()
+        return shortest_path
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir,ignore_errors=True)
+        if stats is not None:
+            stats.times["external_bfs_solve"] += time.perf_counter() - start_time
+
 class DfsState(object):
     def __init__(self,vertex,edge,graph):
         #print("visiting {}".format(vertex.get_key()))
@@ -233,6 +1313,10 @@ class DfsState(object):
         # it will be None for the root of the search
         self.edge = edge
         self.children = vertex.iter_from()
+        # The cost of the path to this vertex, when dfs_solve needs it
+        self.cost = 0
+        # Whether dfs_solve has checked if the vertex is a goal, so that it does so only once per visit
+        self.goal_checked = False
 
     def get_vertex(self):
         return self.vertex
@@ -240,7 +1324,8 @@ class DfsState(object):
     def get_edge(self):
         return self.edge
     
-    def get_next(self,visited):
+    # If live_states is given, children which are not in it (states from which no goal can be reached) are skipped
+    def get_next(self,visited,live_states=None):
         found_valid = False
 
         next_child_edge = None
@@ -250,7 +1335,7 @@ class DfsState(object):
             next_child_edge = next(self.children,None)
             if next_child_edge is not None:
                 next_child = self.graph.find_state(next_child_edge.get_dst_key())
-                found_valid = next_child.get_key() not in visited
+                found_valid = next_child.get_key() not in visited and (live_states is None or next_child.get_key() in live_states)
             else:
                 found_valid = True
             
@@ -259,14 +1344,95 @@ class DfsState(object):
 
         return None
 
-# dfs_solve is a Python generator to find all valid paths from source to dest
-def dfs_solve(graph,src,dst,cycle=False):
+# The weight of an edge for the cost bounds of dfs_solve: get_weight() if the edge has it, otherwise 1
+def edge_weight(edge):
+    get_weight = getattr(edge,"get_weight",None)
+    return get_weight() if get_weight is not None else 1
+
+# GoalDistances finds, by a backward search from the goals, the states from which a goal can be reached
+# . depths: a dictionary from each such state's key to the fewest edges from it to a goal
+# . costs: if "weighted" is true, the same for the lowest cost (see edge_weight); otherwise None
+# A state missing from depths is dead: dfs_solve (prune_dead=True) does not enter it
+# The backward search uses GameVertex.iter_incoming(), so the graph must be eager or built with build_reachable()
+# and keep its incoming edges, or its vertex class must implement gen_incoming_keys().  A goal test function
+# (see make_goal_test) is only possible on a graph whose states all exist already (not in lazy mode)
+class GoalDistances(object):
+    def __init__(self,graph,dst,weighted=False):
+        self.graph = graph
+        goal_keys = self.find_goals(dst)
+        stats = graph.stats
+        if stats is not None:
+            start_time = time.perf_counter()
+        self.depths = self.search(goal_keys,lambda edge: 1)
+        self.costs = self.search(goal_keys,edge_weight) if weighted else None
+        if stats is not None:
+            stats.times["goal_distances"] += time.perf_counter() - start_time
+
+    def find_goals(self,dst):
+        graph = self.graph
+        if callable(dst):
+            # A lazy graph, or a reachable one before build_reachable(), creates states during the searches
+            if graph.mode == "lazy" or (graph.mode == "reachable" and graph.reachable_source is None):
+                raise RuntimeError("A goal test function needs all the states: use an eager graph or build_reachable()")
+            return [key for key, vertex in graph.iterate_states() if dst(vertex)]
+        if dst is None:
+            return list()
+        candidate_keys = dst if isinstance(dst,(set,frozenset)) else [dst]
+        # Outside lazy mode, a goal which is not in the graph cannot be reached
+        find_goal = graph.create_state if graph.mode == "lazy" else graph.find_state
+        return [key for key in candidate_keys if find_goal(key) is not None]
+
+    def search(self,goal_keys,weight_func):
+        # dijkstra's algorithm over the incoming edges, from all the goals at once
+        graph = self.graph
+        inf = float("inf")
+        dist_dict = {goal_key : 0 for goal_key in goal_keys}
+        push_count = itertools.count()
+        dist_heap = [(0,next(push_count),goal_key) for goal_key in goal_keys]
+        settled = set()
+        while dist_heap:
+            cur_dist, _, cur_key = heapq.heappop(dist_heap)
+            if cur_key in settled:
+                continue # stale entry
+            settled.add(cur_key)
+            for edge in graph.find_state(cur_key).iter_incoming():
+                pred_key = edge.get_src_key()
+                new_dist = cur_dist + weight_func(edge)
+                if new_dist < dist_dict.get(pred_key,inf):
+                    dist_dict[pred_key] = new_dist
+                    heapq.heappush(dist_heap,(new_dist,next(push_count),pred_key))
+        return dist_dict
+
+# dfs_solve is a Python generator to find all valid paths from source to dest (or to any goal, see make_goal_test)
+# Optional bounds cut the search short:
+# . max_depth: paths have at most this many edges
+# . max_cost: paths cost at most this much (see edge_weight)
+# . prune_worse: branch and bound -- once a solution is found, paths costing more than the best solution so far are
+#   not extended.  Every optimal solution is still yielded, but so are the worse solutions found before them
+# When the generator is exhausted, its return value (StopIteration.value) tells whether max_depth cut off any path
+# If "prefix" is a list of edges leading from src, only the paths which start with it are searched (this is how
+# parallel_dfs_solve divides the work); the bounds apply to the whole path
+# If "prune_dead" is true, the GoalDistances of dst are found first (or "goal_distances" may be given, to reuse them),
+# and the search never enters a state from which no goal can be reached, or from which no goal can be reached within
+# max_depth or max_cost.  The solutions are the same (but with prune_worse, fewer of the worse ones are yielded); only
+# whole dead branches are skipped
+def dfs_solve(graph,src,dst,cycle=False,max_depth=None,max_cost=None,prune_worse=False,prefix=None,prune_dead=False,
+              goal_distances=None):
 
     # If "cycle" is true, the origin is never added to the visited set
     
+    goal_test = make_goal_test(dst)
+    use_cost = max_cost is not None or prune_worse
+    best_cost = None
+    depth_cut = False
     dfs_stack = list()
     edge_stack = list()
     visited = set()
+    if prune_dead and goal_distances is None:
+        goal_distances = GoalDistances(graph,dst,weighted=use_cost)
+    goal_depths = goal_distances.depths if goal_distances is not None else None
+    goal_costs = goal_distances.costs if goal_distances is not None else None
+    prune_depth = goal_depths is not None and max_depth is not None
 
     if not cycle:
         visited.add(src) # for consistency
@@ -276,16 +1442,56 @@ def dfs_solve(graph,src,dst,cycle=False):
         raise RuntimeError("source state key invalid")
 
     dfs_stack.append(DfsState(src_vertex,None,graph))
+    if prefix:
+        for edge in prefix:
+            # The states along the prefix have no other children, and are not goals
+            prefix_state = dfs_stack[-1]
+            prefix_state.children = iter(())
+            prefix_state.goal_checked = True
+            next_state = DfsState(graph.find_state(edge.get_dst_key()),edge,graph)
+            next_state.cost = prefix_state.cost + edge_weight(edge) if use_cost else 0
+            if edge.get_dst_key() != src:
+                visited.add(edge.get_dst_key())
+            edge_stack.append(edge)
+            dfs_stack.append(next_state)
+    # dfs_solve is a generator, so it is not timed (the time between solutions belongs to the caller); see GraphStats.phase
+    stats = graph.stats
+    if stats is not None:
+        stats.vertices_expanded += 1
 
     while dfs_stack:
         cur_state = dfs_stack[-1]
         cur_key = cur_state.get_vertex().get_key()
         #print("at {}".format(cur_key))
 
-        if len(dfs_stack) > 1 and (cur_key == dst):
+        if not cur_state.goal_checked and len(dfs_stack) > 1 and goal_test(cur_state.get_vertex()):
+            if prune_worse and (best_cost is None or cur_state.cost < best_cost):
+                best_cost = cur_state.cost
+            if graph.deferred_edges:
+                # Only the edges of solutions are materialized; they stay so in the stack
+                for edge_idx, edge in enumerate(edge_stack):
+                    edge_stack[edge_idx] = real_edge(edge)
             yield edge_stack # found a solution
+        cur_state.goal_checked = True
             
-        next_state = cur_state.get_next(visited)
+        next_state = cur_state.get_next(visited,goal_depths)
+        if next_state is not None and max_depth is not None and len(edge_stack) >= max_depth:
+            depth_cut = True
+            next_state = None
+        while next_state is not None and (use_cost or prune_depth):
+            next_key = next_state.get_vertex().get_key()
+            if prune_depth and len(edge_stack) + 1 + goal_depths[next_key] > max_depth:
+                depth_cut = True # a goal may be reached from here, but only beyond max_depth
+            elif not use_cost:
+                break
+            else:
+                next_state.cost = cur_state.cost + edge_weight(next_state.get_edge())
+                # With the distances to the goals, the cost of the cheapest solution through the child
+                bound_cost = next_state.cost + goal_costs[next_key] if goal_costs is not None else next_state.cost
+                if (max_cost is None or bound_cost <= max_cost) and (best_cost is None or bound_cost <= best_cost):
+                    break
+            next_state = cur_state.get_next(visited,goal_depths)
+
         if next_state is not None and ((len(dfs_stack) == 1) or (cur_key != src)):
             # Go deeper
             next_key = next_state.get_vertex().get_key()
@@ -294,79 +1500,872 @@ def dfs_solve(graph,src,dst,cycle=False):
                 visited.add(next_key)
             edge_stack.append(next_state.get_edge())
             dfs_stack.append(next_state)
+            if stats is not None:
+                stats.vertices_expanded += 1
+                stats.note_frontier(len(dfs_stack))
         else:
-            # Pop
-            visited.remove(cur_state.get_vertex().get_key())
+            # Pop ("discard", since in cycle mode the origin is not in the set)
+            visited.discard(cur_state.get_vertex().get_key())
             if len(dfs_stack) > 1:
                 # The dfs stack is one longer than the edge stack (because N vertices are connected by N-1 edges)
                 edge_stack.pop()
             dfs_stack.pop()
 
-# Returns whether left is less than or equal to right
-# This function covers the "inf" vs "inf" case, as it should to update the initial value
-def dijkstra_less(left,right):
-    if left == "inf":
-        return right == "inf"
-    elif right == "inf":
-        return True
-    else:
-        return left < right
- 
-def dijkstra(graph,src,dst):
-    # Use dijkstra's algorithm to find the shortest weighted path
-    dijk_dict = dict()
+    return depth_cut
+
+# iterative_dfs_solve runs dfs_solve with max_depth 1, 2, 3... and yields the solutions of exactly that length,
+# so solutions come out shortest first.  It stops "extra_depth" levels after the first solution is found (so 0 gives
+# all the shortest solutions), when max_depth is reached, or when no path was cut off by the depth limit
+# The other arguments are passed to dfs_solve
+def iterative_dfs_solve(graph,src,dst,extra_depth=0,max_depth=None,cycle=False,max_cost=None,prune_worse=False,prune_dead=False):
+    last_depth = max_depth
+    depth = 1
+    # The distances to the goals are found once for all the depths
+    goal_distances = GoalDistances(graph,dst,weighted=max_cost is not None or prune_worse) if prune_dead else None
+    while last_depth is None or depth <= last_depth:
+        search = dfs_solve(graph,src,dst,cycle=cycle,max_depth=depth,max_cost=max_cost,prune_worse=prune_worse,
+                           goal_distances=goal_distances)
+        found_solution = False
+        while True:
+            try:
+                solution = next(search)
+            except StopIteration as search_end:
+                depth_cut = search_end.value
+                break
+            if len(solution) == depth:
+                found_solution = True
+                yield solution
+
+        if found_solution and (last_depth is None or depth + extra_depth < last_depth):
+            last_depth = depth + extra_depth
+        if not depth_cut:
+            break
+        depth += 1
+
+def dijkstra(graph,src,dst,all_goals=False):
+    # Use dijkstra's algorithm to find the shortest weighted path to the nearest goal
+    # "all_goals" is as for bfs_solve
+    dijk_parent, reached = dijkstra_build_tree(graph,src,dst,all_goals)
+    if all_goals:
+        return all_goals_result(dijk_parent,src,reached,weighted_path_cost)
+    return path_from_tree(dijk_parent,src,reached[0]) if reached else list()
+
+# Construct the shortest path tree of dijkstra's algorithm, mapping each key to the edge which reaches it,
+# until a goal is settled.  "all_goals" and the result are as for bfs_build_tree
+# In lazy mode this is uniform-cost search: states are created as they are reached through iter_from(), so only the
+# states no farther than the goal (and their neighbors) are ever built
+def dijkstra_build_tree(graph,src,dst=None,all_goals=False):
+    goal_test = make_goal_test(dst)
+    goals_left = len(dst) if isinstance(dst,(set,frozenset)) else None
+    reached = list()
+    # The priority queue uses lazy deletion: a vertex may be pushed several times as its distance improves,
+    # and stale entries are skipped when popped.  The sequence number breaks ties, since keys need not be ordered
+    dijk_dict = dict() # Best known distance; a missing key means infinity
     dijk_parent = dict() # Keep track of the edges
-    unvisited = set()
-    for key,value in graph.iterate_states():
-        dijk_dict[key] = "inf"
-        unvisited.add(key)
+    visited = set()
 
    # print ("source is {}, states {}".format(str(src),str(graph)))
-    if graph.find_state(src) is None:
+    # "create_state" because in lazy mode the source may not exist yet
+    if graph.create_state(src) is None:
         raise RuntimeError("source state key invalid")
-        
+    stats = graph.stats
+    if stats is not None:
+        start_time = time.perf_counter()
+
+    inf = float("inf")
     dijk_dict[src] = 0
+    dijk_parent[src] = None
+    push_count = itertools.count()
+    dijk_heap = [(0,next(push_count),src)]
 
-    while len(unvisited) > 0:
+    while dijk_heap:
         # Find the current vertex
-        min_dist = "inf"
-        min_key = None # will be update on the first compare -- see dijkstra_compare
-        for key in unvisited:
-            dist = dijk_dict[key]
-         #   print ("key {} dist {}".format(key,dist))
-            if dijkstra_less(dist,min_dist):
-                min_dist = dist
-                min_key = key
-
-      #  print("min dist {}".format(min_dist))
-        if min_dist == "inf":
-            break
+        min_dist, _, min_key = heapq.heappop(dijk_heap)
+        if min_key in visited:
+            continue # stale entry
+        visited.add(min_key)
         cur_vertex = graph.find_state(min_key)
+
+        if goal_test(cur_vertex):
+            reached.append(min_key)
+            if not all_goals or len(reached) == goals_left:
+                # The destination is settled; no shorter path can be found
+                break
         #print ("cur vertex is {}".format(str(cur_vertex)))
         
         for neighbor_edge in cur_vertex.iter_from():
             dst_node_key = neighbor_edge.get_dst_key()
             #print("considering neighbor {}".format(str(neighbor_edge)))
-            if dst_node_key in unvisited:
-                cur_dist = dijk_dict[dst_node_key]
+            if dst_node_key not in visited:
                 new_dist = min_dist + neighbor_edge.get_weight()
-                if dijkstra_less(new_dist,cur_dist):
+                if new_dist < dijk_dict.get(dst_node_key,inf):
                     #print("updating total path to {}".format(new_dist))
                     dijk_dict[dst_node_key] = new_dist
                     dijk_parent[dst_node_key] = neighbor_edge
-                    
-        unvisited.remove(min_key)
+                    heapq.heappush(dijk_heap,(new_dist,next(push_count),dst_node_key))
+        if stats is not None:
+            stats.vertices_expanded += 1
+            stats.note_frontier(len(dijk_heap))
+
+    if stats is not None:
+        stats.times["dijkstra_build_tree"] += time.perf_counter() - start_time
+    return dijk_parent, reached
+
+# k_shortest_paths returns the k shortest simple paths (no state repeated) from src to a goal, in order of cost, by
+# Yen's algorithm: each path after the first is the cheapest "spur" from a state on a path already found, whose
+# prefix up to that state is kept, avoiding the edges that the paths already found take from the same prefix
+# The cost is that of edge_weight: the sum of get_weight(), or the number of edges for unweighted edge classes
+# As for bfs_solve, a path ends at the first goal it reaches.  Fewer than k paths are returned if there are no more
+# Each path found costs one search like dijkstra's per edge of it.  An admissible heuristic, as for astar_solve,
+# makes these searches A* searches; once enough candidates are known, spurs which cannot beat them are not searched for
+def k_shortest_paths(graph,src,dst,k,heuristic=None):
+    if k <= 0:
+        return list()
+    goal_test = make_goal_test(dst)
+    stats = graph.stats
+    if stats is not None:
+        start_time = time.perf_counter()
+
+    found_paths = list()
+    first_path = spur_search(graph,src,goal_test,frozenset(),frozenset(),heuristic)
+    if first_path is not None:
+        found_paths.append(first_path)
+    candidate_heap = list()
+    candidate_keys = set()
+    push_count = itertools.count()
+    while found_paths and len(found_paths) < k:
+        last_path = found_paths[-1]
+        root_cost = 0
+        root_states = {src}
+        for spur_idx in range(len(last_path)):
+            spur_key = last_path[spur_idx-1].get_dst_key() if spur_idx > 0 else src
+            # The states which the paths found so far go to after the same root
+            blocked_steps = set()
+            for path in found_paths:
+                if len(path) > spur_idx and all(edge_keys(path[edge_idx]) == edge_keys(last_path[edge_idx]) for edge_idx in range(spur_idx)):
+                    blocked_steps.add(path[spur_idx].get_dst_key())
+            # Only the candidates which can still be among the k shortest are worth finding
+            paths_needed = k - len(found_paths)
+            max_cost = None
+            if len(candidate_heap) >= paths_needed:
+                max_cost = heapq.nsmallest(paths_needed,candidate_heap)[-1][0] - root_cost
+            # The root's states are blocked, other than the spur state, so the path stays simple
+            spur_path = spur_search(graph,spur_key,goal_test,root_states - {spur_key},blocked_steps,heuristic,max_cost)
+            if spur_path is not None:
+                new_path = last_path[:spur_idx] + spur_path
+                new_keys = tuple(edge_keys(edge) for edge in new_path)
+                if new_keys not in candidate_keys:
+                    candidate_keys.add(new_keys)
+                    new_cost = root_cost + sum(edge_weight(edge) for edge in spur_path)
+                    heapq.heappush(candidate_heap,(new_cost,next(push_count),new_path))
+            root_cost += edge_weight(last_path[spur_idx])
+            root_states.add(last_path[spur_idx].get_dst_key())
+        if not candidate_heap:
+            break
+        found_paths.append(heapq.heappop(candidate_heap)[2])
+
+    if stats is not None:
+        stats.times["k_shortest_paths"] += time.perf_counter() - start_time
+    return found_paths
+
+def edge_keys(edge):
+    return (edge.get_src_key(),edge.get_dst_key())
+
+# The cheapest path from src to a goal (see edge_weight) which avoids the blocked states, and whose first step is not
+# to one of the blocked_steps keys, stopping at the first goal; None if there is none, or if it would cost more than
+# max_cost.  The search is that of astar_solve, or of dijkstra_build_tree without a heuristic
+def spur_search(graph,src,goal_test,blocked_states,blocked_steps,heuristic=None,max_cost=None):
+    src_vertex = graph.create_state(src)
+    if src_vertex is None:
+        raise RuntimeError("source state key invalid")
+    stats = graph.stats
+    inf = float("inf")
+    max_priority = inf if max_cost is None else max_cost
+    spur_dist = {src : 0}
+    spur_parent = {src : None}
+    push_count = itertools.count()
+    spur_heap = [(heuristic(src_vertex) if heuristic is not None else 0,next(push_count),0,src)]
+    while spur_heap:
+        priority, _, cur_dist, cur_key = heapq.heappop(spur_heap)
+        if priority > max_priority:
+            break
+        if cur_dist > spur_dist[cur_key]:
+            continue # stale entry
+        cur_vertex = graph.find_state(cur_key)
+        if goal_test(cur_vertex):
+            return path_from_tree(spur_parent,src,cur_key)
+        for neighbor_edge in cur_vertex.iter_from():
+            neighbor_key = neighbor_edge.get_dst_key()
+            if neighbor_key in blocked_states or (cur_key == src and neighbor_key in blocked_steps):
+                continue
+            new_dist = cur_dist + edge_weight(neighbor_edge)
+            if new_dist < spur_dist.get(neighbor_key,inf):
+                spur_dist[neighbor_key] = new_dist
+                spur_parent[neighbor_key] = neighbor_edge
+                new_priority = new_dist + heuristic(graph.find_state(neighbor_key)) if heuristic is not None else new_dist
+                heapq.heappush(spur_heap,(new_priority,next(push_count),new_dist,neighbor_key))
+        if stats is not None:
+            stats.vertices_expanded += 1
+            stats.note_frontier(len(spur_heap))
+    return None
+
+# The following two functions are bfs_solve and dijkstra on a CompiledGraph
+# They take and return the same keys and edges, but the search itself only touches integer arrays
+def compiled_bfs_solve(compiled,src,dst):
+    src_id = compiled.get_id(src)
+    if src_id is None:
+        raise RuntimeError("source state key invalid")
+    dst_id = compiled.get_id(dst)
+    if dst_id is None:
+        return list()
+
+    offsets = compiled.offsets
+    targets = compiled.targets
+    # parent_edge[i] is the index of the edge used to reach i; -1 means unvisited
+    parent_edge = array.array("q",[-1]) * compiled.num_states()
+    parent_edge[src_id] = -2 # visited, but has no parent
+
+    bfs_queue = collections.deque([src_id])
+    found_state = src_id == dst_id
+    while bfs_queue and not found_state:
+        cur_id = bfs_queue.popleft()
+        for edge_idx in range(offsets[cur_id],offsets[cur_id+1]):
+            neighbor_id = targets[edge_idx]
+            if parent_edge[neighbor_id] == -1:
+                parent_edge[neighbor_id] = edge_idx
+                if neighbor_id == dst_id:
+                    found_state = True
+                    break
+                bfs_queue.append(neighbor_id)
+
+    if found_state:
+        return compiled.edge_path(parent_edge,src_id,dst_id)
+    return list()
+
+def compiled_dijkstra(compiled,src,dst):
+    if compiled.weights is None:
+        raise RuntimeError("compiled graph has no weights")
+    src_id = compiled.get_id(src)
+    if src_id is None:
+        raise RuntimeError("source state key invalid")
+    dst_id = compiled.get_id(dst)
+    if dst_id is None:
+        return list()
+
+    offsets = compiled.offsets
+    targets = compiled.targets
+    weights = compiled.weights
+    num_states = compiled.num_states()
+    dist = array.array("d",[float("inf")]) * num_states
+    parent_edge = array.array("q",[-1]) * num_states
+    visited = bytearray(num_states)
+
+    dist[src_id] = 0
+    dijk_heap = [(0,src_id)]
+    while dijk_heap:
+        min_dist, cur_id = heapq.heappop(dijk_heap)
+        if visited[cur_id]:
+            continue # stale entry
+        visited[cur_id] = 1
+        if cur_id == dst_id:
+            break
+
+        for edge_idx in range(offsets[cur_id],offsets[cur_id+1]):
+            neighbor_id = targets[edge_idx]
+            if not visited[neighbor_id]:
+                new_dist = min_dist + weights[edge_idx]
+                if new_dist < dist[neighbor_id]:
+                    dist[neighbor_id] = new_dist
+                    parent_edge[neighbor_id] = edge_idx
+                    heapq.heappush(dijk_heap,(new_dist,neighbor_id))
+
+    if visited[dst_id] and dst_id != src_id:
+        return compiled.edge_path(parent_edge,src_id,dst_id)
+    return list()
+
+# astar_solve finds the shortest weighted path like dijkstra, but orders the search by distance plus heuristic(vertex),
+# an estimate of the remaining distance to dst.  The estimate must never exceed the true remaining distance (it must be
+# "admissible"), otherwise the path may not be the shortest
+# Works in both eager and lazy mode: states are created on demand through create_state() and iter_from()
+def astar_solve(graph,src,dst,heuristic):
+    src_vertex = graph.create_state(src)
+    if src_vertex is None:
+        raise RuntimeError("source state key invalid")
+
+    stats = graph.stats
+    if stats is not None:
+        start_time = time.perf_counter()
+
+    inf = float("inf")
+    dist_dict = {src : 0}
+    astar_parent = dict()
+    push_count = itertools.count()
+    astar_heap = [(heuristic(src_vertex),next(push_count),0,src_vertex)]
+
+    found_state = False
+    while astar_heap:
+        _, _, cur_dist, cur_vertex = heapq.heappop(astar_heap)
+        cur_key = cur_vertex.get_key()
+        if cur_dist > dist_dict[cur_key]:
+            continue # stale entry
+        if cur_key == dst:
+            found_state = True
+            break
+
+        for neighbor_edge in cur_vertex.iter_from():
+            neighbor_key = neighbor_edge.get_dst_key()
+            new_dist = cur_dist + neighbor_edge.get_weight()
+            if new_dist < dist_dict.get(neighbor_key,inf):
+                dist_dict[neighbor_key] = new_dist
+                astar_parent[neighbor_key] = neighbor_edge
+                neighbor_vertex = graph.find_state(neighbor_key)
+                heapq.heappush(astar_heap,(new_dist + heuristic(neighbor_vertex),next(push_count),new_dist,neighbor_vertex))
+        if stats is not None:
+            stats.vertices_expanded += 1
+            stats.note_frontier(len(astar_heap))
 
     shortest_path = list()
-    if dst in dijk_parent:
+    if found_state:
         cur_path_key = dst
         while cur_path_key != src:
-            cur_edge = dijk_parent[cur_path_key]
-            shortest_path.append(cur_edge)
+            cur_edge = astar_parent[cur_path_key]
+            shortest_path.append(real_edge(cur_edge))
             cur_path_key = cur_edge.get_src_key()
-          #  print("new cpk {}".format(cur_path_key))
-        return list(reversed(shortest_path))
+        shortest_path.reverse()
 
+    if stats is not None:
+        stats.times["astar_solve"] += time.perf_counter() - start_time
     return shortest_path
-            
-        
+
+# SolverCache memoizes bfs_solve and dijkstra.  For each (graph fingerprint, algorithm, source) it keeps the complete
+# shortest path tree from the source, so that every later query from the same source is answered without searching
+# At most max_trees trees are kept; the least recently used one is dropped first
+# A tree is rebuilt when the graph has been changed through add_state() or link() since the tree was built.
+# Graphs with the same fingerprint share trees, so the edges returned may belong to another graph built the same way;
+# but only while neither graph has been edited (see GameGraph.edit_count).  A tree built on an edited graph only
+# serves that graph, and a tree built on another graph never serves an edited one
+# The fingerprint of each graph is computed again only when its mutation_count has changed
+class SolverCache(object):
+    TREE_BUILDERS = {"bfs" : bfs_build_tree, "dijkstra" : dijkstra_build_tree}
+
+    def __init__(self,max_trees=64):
+        self.max_trees = max_trees
+        self.trees = collections.OrderedDict()
+        # For each graph: (mutation_count, fingerprint)
+        self.fingerprints = weakref.WeakKeyDictionary()
+
+    def get_fingerprint(self,graph):
+        cached = self.fingerprints.get(graph)
+        if cached is not None and cached[0] == graph.mutation_count:
+            return cached[1]
+        fingerprint = graph.fingerprint()
+        self.fingerprints[graph] = (graph.mutation_count,fingerprint)
+        return fingerprint
+
+    def get_tree(self,graph,algorithm,src):
+        cache_key = (self.get_fingerprint(graph),algorithm,src)
+        cached = self.trees.get(cache_key)
+        if cached is not None:
+            owner_ref, mutation_count, shared, tree = cached
+            if owner_ref() is graph:
+                is_current = mutation_count == graph.mutation_count
+            else:
+                is_current = shared and graph.edit_count == 0
+            if is_current:
+                self.trees.move_to_end(cache_key)
+                return tree
+
+        tree = SolverCache.TREE_BUILDERS[algorithm](graph,src)[0]
+        # Building the tree may itself create states in lazy mode, so take the count afterwards
+        self.trees[cache_key] = (weakref.ref(graph),graph.mutation_count,graph.edit_count == 0,tree)
+        self.trees.move_to_end(cache_key)
+        while len(self.trees) > self.max_trees:
+            self.trees.popitem(last=False)
+        return tree
+
+    def bfs_solve(self,graph,src,dst):
+        return path_from_tree(self.get_tree(graph,"bfs",src),src,dst)
+
+    def dijkstra(self,graph,src,dst):
+        return path_from_tree(self.get_tree(graph,"dijkstra",src),src,dst)
+
+    def clear(self):
+        self.trees.clear()
+
+# ShortestPathTree keeps the shortest paths from one source to every reachable state, and repairs them after the
+# graph changes (see GameGraph.remove_state and the functions after it), in the style of dynamic single-source
+# shortest paths: only the states whose distance may have changed are searched again
+# . states whose tree path used a removed edge lose their distance, and are searched again from the edges into them
+#   from the other states
+# . added edges (and edges built again with a new weight) lower distances where they give a shorter path
+# Both steps share one Dijkstra search, seeded with those edges instead of the source.  Edge weights are given by
+# edge_weight() (get_weight(), or 1 for unweighted edges).  States are created through create_state() and iter_from(),
+# so the tree can also be built on a lazy graph
+class ShortestPathTree(object):
+    def __init__(self,graph,src):
+        if graph.create_state(src) is None:
+            raise RuntimeError("source state key invalid")
+        self.graph = graph
+        self.src = src
+        self.dist = {src : 0}
+        self.parent = {src : None}
+        self.children = collections.defaultdict(set)
+        self.push_count = itertools.count()
+        self.search([(0,next(self.push_count),src)])
+
+    def distance(self,key):
+        # The distance from the source, or None if the state cannot be reached
+        return self.dist.get(key)
+
+    def path_to(self,key):
+        return path_from_tree(self.parent,self.src,key)
+
+    def set_parent(self,key,edge):
+        old_edge = self.parent.get(key)
+        if old_edge is not None:
+            self.children[old_edge.get_src_key()].discard(key)
+        self.parent[key] = edge
+        self.children[edge.get_src_key()].add(key)
+
+    def relax(self,edge,heap):
+        src_dist = self.dist.get(edge.get_src_key())
+        dst_key = edge.get_dst_key()
+        if src_dist is None or self.graph.find_state(dst_key) is None:
+            return
+        new_dist = src_dist + edge_weight(edge)
+        if dst_key not in self.dist or new_dist < self.dist[dst_key]:
+            self.dist[dst_key] = new_dist
+            self.set_parent(dst_key,edge)
+            heapq.heappush(heap,(new_dist,next(self.push_count),dst_key))
+
+    def search(self,heap):
+        while heap:
+            min_dist, _, min_key = heapq.heappop(heap)
+            if self.dist.get(min_key) != min_dist:
+                continue # stale entry
+            vertex = self.graph.find_state(min_key)
+            if vertex is None:
+                continue
+            for edge in vertex.iter_from():
+                self.relax(edge,heap)
+
+    def repair(self,removed_edges=(),added_edges=()):
+        if self.graph.find_state(self.src) is None:
+            raise RuntimeError("The source state of the tree has been removed")
+
+        # The subtrees below removed tree edges
+        affected = set()
+        affected_stack = [edge.get_dst_key() for edge in removed_edges if self.parent.get(edge.get_dst_key()) is edge]
+        while affected_stack:
+            key = affected_stack.pop()
+            if key not in affected:
+                affected.add(key)
+                affected_stack.extend(self.children.get(key,()))
+        for key in affected:
+            del self.dist[key]
+            edge = self.parent.pop(key)
+            self.children[edge.get_src_key()].discard(key)
+
+        heap = list()
+        for key in affected:
+            vertex = self.graph.find_state(key)
+            if vertex is not None:
+                for edge in self.graph.find_incoming_edges(vertex):
+                    self.relax(edge,heap)
+        for edge in added_edges:
+            self.relax(edge,heap)
+        self.search(heap)
+
+# BatchSolver answers many (src, dst) queries on one graph concurrently, on a pool of threads or processes
+# Queries with the same source are answered by one search toward all their destinations (see all_goals)
+# . Threads share the graph, which must not change during the queries: it must be eager, or built with
+#   build_reachable().  Each search keeps its own state, so no locks are needed (but a GraphStats attached to the
+#   graph may miss some counts).  Threads help a server stay responsive, but because of the GIL they do not run
+#   searches in parallel
+# . Processes each get a copy of the graph without its states (see GameGraph.worker_copy), and build it again
+#   the same way: in full for eager graphs, from the same source for reachable ones, on demand for lazy ones.
+#   Paths come back as pairs of keys and are turned into the main graph's edges with find_edge()
+# solve_many() blocks; submit() returns a concurrent.futures.Future, and "await solver.solve(src,dst)" can be used
+# from asyncio code without blocking the event loop
+class BatchSolver(object):
+    def __init__(self,graph,algorithm="bfs",workers=None,use_processes=False):
+        if algorithm not in SolverCache.TREE_BUILDERS:
+            raise RuntimeError("Unknown algorithm {}; use one of {}".format(algorithm,", ".join(sorted(SolverCache.TREE_BUILDERS))))
+        self.graph = graph
+        self.algorithm = algorithm
+        self.use_processes = use_processes
+        if use_processes:
+            self.pool = concurrent.futures.ProcessPoolExecutor(workers,initializer=init_solver_worker,initargs=(graph.worker_copy(),))
+        else:
+            # A lazy graph, or a reachable one before build_reachable(), creates states during the searches
+            if graph.mode == "lazy" or (graph.mode == "reachable" and graph.reachable_source is None):
+                raise RuntimeError("Threads need a graph which does not change: use an eager graph, build_reachable(), or use_processes=True")
+            self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+    def close(self):
+        self.pool.shutdown()
+
+    def submit_source(self,src,dsts):
+        # A future for a dictionary from each of the destination keys to its path from src
+        if self.use_processes:
+            key_future = self.pool.submit(solve_source_in_worker,self.algorithm,src,list(dsts))
+            result_future = concurrent.futures.Future()
+            key_future.add_done_callback(lambda done: self.finish_source(done,result_future))
+            return result_future
+        return self.pool.submit(solve_source,self.graph,self.algorithm,src,dsts)
+
+    def finish_source(self,key_future,result_future):
+        # Turn the key pairs computed by a worker process into edges of the graph
+        if key_future.exception() is not None:
+            result_future.set_exception(key_future.exception())
+            return
+        try:
+            paths = dict()
+            for dst, key_pairs in key_future.result():
+                paths[self.graph.adopt_key(dst)] = [real_edge(self.graph.find_edge(self.graph.adopt_key(src_key),self.graph.adopt_key(dst_key)))
+                                                    for src_key, dst_key in key_pairs]
+            result_future.set_result(paths)
+        except Exception as error:
+            result_future.set_exception(error)
+
+    def submit(self,src,dst):
+        path_future = concurrent.futures.Future()
+        def finish(done):
+            if done.exception() is not None:
+                path_future.set_exception(done.exception())
+            else:
+                path_future.set_result(done.result()[dst])
+        self.submit_source(src,[dst]).add_done_callback(finish)
+        return path_future
+
+    def submit_many(self,queries):
+        # One future per distinct source of the (src, dst) pairs
+        dsts_by_src = dict()
+        for src, dst in queries:
+            dsts_by_src.setdefault(src,set()).add(dst)
+        return {src : self.submit_source(src,dsts) for src, dsts in dsts_by_src.items()}
+
+    def solve_many(self,queries):
+        # Answer a list of (src, dst) pairs; returns the list of paths, in the same order
+        futures = self.submit_many(queries)
+        return [futures[src].result()[dst] for src, dst in queries]
+
+    async def solve(self,src,dst):
+        return await asyncio.wrap_future(self.submit(src,dst))
+
+    async def solve_many_async(self,queries):
+        futures = self.submit_many(queries)
+        results = dict(zip(futures,await asyncio.gather(*(asyncio.wrap_future(future) for future in futures.values()))))
+        return [results[src][dst] for src, dst in queries]
+
+# Solve one source for a set of destination keys: one search, stopped when all of them are reached
+def solve_source(graph,algorithm,src,dsts):
+    build_tree = SolverCache.TREE_BUILDERS[algorithm]
+    tree = build_tree(graph,src,frozenset(dsts),True)[0]
+    return {dst : path_from_tree(tree,src,dst) for dst in dsts}
+
+# Worker process side of BatchSolver and parallel_dfs_solve
+solver_graph = None
+solver_queue = None
+solver_stop = None
+solver_goal_distances = None
+
+def init_solver_worker(graph,result_queue=None,stop_event=None):
+    global solver_graph, solver_queue, solver_stop, solver_goal_distances
+    solver_graph = graph
+    solver_queue = result_queue
+    solver_stop = stop_event
+    # Found for the previous pool's graph and destination (a forked worker inherits it from its parent)
+    solver_goal_distances = None
+    if graph.mode == "eager":
+        graph.define_states()
+        for key, vx in list(graph.iterate_states()):
+            graph.add_transitions(vx)
+    elif graph.reachable_source is not None:
+        graph.build_reachable(graph.reachable_source)
+
+def solve_source_in_worker(algorithm,src,dsts):
+    paths = solve_source(solver_graph,algorithm,src,dsts)
+    return [(dst,[(edge.get_src_key(),edge.get_dst_key()) for edge in path]) for dst, path in paths.items()]
+
+class DfsTaskStopped(Exception):
+    pass
+
+# Search one subtree for parallel_dfs_solve, sending the solutions to the main process in batches of key pairs
+# The goal test also checks, every STOP_CHECK_STATES states, whether the main process has stopped listening
+def dfs_task_in_worker(task_id,src,dst,prefix_keys,cycle,max_depth,max_cost,prune_worse,prune_dead,batch_size):
+    global solver_goal_distances
+    graph = solver_graph
+    prefix = [graph.find_edge(graph.adopt_key(src_key),graph.adopt_key(dst_key)) for src_key, dst_key in prefix_keys]
+    if isinstance(dst,(set,frozenset)):
+        dst = frozenset(graph.adopt_key(goal_key) for goal_key in dst)
+    elif dst is not None:
+        dst = graph.adopt_key(dst)
+    goal_test = make_goal_test(dst)
+    if prune_dead and solver_goal_distances is None:
+        # Found once per worker: the tasks of a pool all have the same destination
+        solver_goal_distances = GoalDistances(graph,dst,weighted=max_cost is not None or prune_worse)
+    state_count = 0
+    def task_goal_test(vertex):
+        nonlocal state_count
+        state_count += 1
+        if state_count % PARALLEL_DFS_STOP_CHECK_STATES == 0 and solver_stop.is_set():
+            raise DfsTaskStopped()
+        return goal_test(vertex)
+
+    search = dfs_solve(graph,graph.adopt_key(src),task_goal_test,cycle=cycle,max_depth=max_depth,max_cost=max_cost,
+                       prune_worse=prune_worse,prefix=prefix,goal_distances=solver_goal_distances)
+    batch = list()
+    try:
+        while True:
+            try:
+                solution = next(search)
+            except StopIteration as search_end:
+                depth_cut = search_end.value
+                break
+            batch.append([(edge.get_src_key(),edge.get_dst_key()) for edge in solution])
+            if len(batch) >= batch_size:
+                if solver_stop.is_set():
+                    return
+                solver_queue.put(("solutions",task_id,batch))
+                batch = list()
+    except DfsTaskStopped:
+        return
+    if batch:
+        solver_queue.put(("solutions",task_id,batch))
+    solver_queue.put(("done",task_id,depth_cut))
+
+PARALLEL_DFS_STOP_CHECK_STATES = 4096
+
+# parallel_dfs_solve finds the same paths as dfs_solve, on a pool of processes
+# The paths of split_depth edges from src are enumerated first (within max_cost), and the subtree below each of them
+# is an independent task: dfs_solve with that path as its prefix.  The workers build the graph as for BatchSolver,
+# and the solutions stream back (in batches of batch_size) as they are found, turned into the main graph's edges
+# . The solutions come out in a different order than from dfs_solve, and the order changes from run to run
+# . prune_worse only prunes with the best cost found by the same task, so more worse solutions are yielded
+# . dst must be a key, a set of keys or None: a goal test function cannot be sent to the workers
+# . with prune_dead, the main process and each worker find the GoalDistances, and no task starts in a dead state
+# The return value is that of dfs_solve.  Closing the generator early stops the workers
+def parallel_dfs_solve(graph,src,dst,split_depth=2,workers=None,cycle=False,max_depth=None,max_cost=None,
+                       prune_worse=False,prune_dead=False,batch_size=64):
+    if callable(dst):
+        raise RuntimeError("parallel_dfs_solve needs a goal key or set of keys, not a function")
+    if max_depth is not None and max_depth <= split_depth:
+        # Nothing is left to split
+        return (yield from dfs_solve(graph,src,dst,cycle=cycle,max_depth=max_depth,max_cost=max_cost,prune_worse=prune_worse,
+                                     prune_dead=prune_dead))
+
+    goal_test = make_goal_test(dst)
+    goal_distances = GoalDistances(graph,dst,weighted=max_cost is not None) if prune_dead else None
+    task_prefixes = list()
+    for path in dfs_solve(graph,src,lambda vertex: True,cycle=cycle,max_depth=split_depth,max_cost=max_cost):
+        if goal_distances is not None:
+            last_key = path[-1].get_dst_key()
+            if (last_key not in goal_distances.depths or
+                (max_depth is not None and len(path) + goal_distances.depths[last_key] > max_depth) or
+                (max_cost is not None and sum(edge_weight(edge) for edge in path) + goal_distances.costs[last_key] > max_cost)):
+                continue # no solution goes through this path
+        if len(path) == split_depth:
+            # The last state of the prefix is checked by the task
+            task_prefixes.append([(edge.get_src_key(),edge.get_dst_key()) for edge in path])
+        elif goal_test(graph.find_state(path[-1].get_dst_key())):
+            yield [real_edge(edge) for edge in path]
+    if not task_prefixes:
+        return False
+
+    result_queue = multiprocessing.Queue(max(4,2*(workers or os.cpu_count() or 1)))
+    stop_event = multiprocessing.Event()
+    pool = concurrent.futures.ProcessPoolExecutor(workers,initializer=init_solver_worker,
+                                                  initargs=(graph.worker_copy(),result_queue,stop_event))
+    found_edges = dict()
+    def find_edge(src_key,dst_key):
+        edge_keys = (src_key,dst_key)
+        if edge_keys not in found_edges:
+            found_edges[edge_keys] = real_edge(graph.find_edge(graph.adopt_key(src_key),graph.adopt_key(dst_key)))
+        return found_edges[edge_keys]
+
+    futures = [pool.submit(dfs_task_in_worker,task_id,src,dst,prefix_keys,cycle,max_depth,max_cost,prune_worse,prune_dead,batch_size)
+               for task_id, prefix_keys in enumerate(task_prefixes)]
+    depth_cut = False
+    tasks_left = len(futures)
+    try:
+        while tasks_left > 0:
+            try:
+                kind, task_id, payload = result_queue.get(timeout=0.1)
+            except queue.Empty:
+                # A task which failed sends nothing more
+                for future in futures:
+                    if future.done() and future.exception() is not None:
+                        raise future.exception()
+                continue
+            if kind == "solutions":
+                for key_pairs in payload:
+                    yield [find_edge(src_key,dst_key) for src_key, dst_key in key_pairs]
+            else:
+                tasks_left -= 1
+                depth_cut = depth_cut or payload
+    finally:
+        stop_event.set()
+        for future in futures:
+            future.cancel()
+        # Keep the queue drained, so that no worker is left blocked on it
+        while not all(future.done() for future in futures):
+            try:
+                result_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        pool.shutdown()
+    return depth_cut
+
+# Retrograde analysis of two-player games
+# A two-player game is a graph whose edges are the moves of the player to move in the source state (the key must
+# therefore say whose turn it is, unless the game is impartial, as Nim is).  Each state is labelled from the point of
+# view of the player to move: RESULT_WIN, RESULT_LOSS or RESULT_DRAW, with the number of moves (plies) to the end of
+# the game under best play -- the winner ends it as soon as possible, the loser as late as possible
+# A vertex class may implement game_result(), returning one of the three results if the game is over in that state, or
+# None if it goes on.  Without it, or when it returns None for a state without moves, having no moves is a loss
+RESULT_DRAW = 0
+RESULT_WIN = 1
+RESULT_LOSS = 2
+RESULT_NAMES = {RESULT_DRAW : "draw", RESULT_WIN : "win", RESULT_LOSS : "loss"}
+
+# retrograde_analysis works backward from the finished games, on the CompiledGraph of the game (so every state and
+# edge must exist: use an eager graph, or build_reachable() from the start position)
+# States won by moving to a lost state are found at once; lost states are found when the count of their moves to
+# states not yet known to be won drops to zero.  States never labelled are draws.  The work is linear in the edges
+# Returns a RetrogradeTable
+def retrograde_analysis(graph):
+    compiled = graph.compile(weighted=False)
+    num_states = compiled.num_states()
+    offsets = compiled.offsets
+    targets = compiled.targets
+
+    # The predecessors of each state, in compressed sparse row form like the successors
+    pred_offsets = array.array("q",[0]) * (num_states + 1)
+    for target_id in targets:
+        pred_offsets[target_id + 1] += 1
+    for state_id in range(num_states):
+        pred_offsets[state_id + 1] += pred_offsets[state_id]
+    pred_sources = array.array("q",[0]) * len(targets)
+    fill = array.array("q",pred_offsets[:-1])
+    for state_id in range(num_states):
+        for edge_idx in range(offsets[state_id],offsets[state_id+1]):
+            target_id = targets[edge_idx]
+            pred_sources[fill[target_id]] = state_id
+            fill[target_id] += 1
+
+    labels = bytearray(num_states)
+    depths = array.array("q",[0]) * num_states
+    # The moves of each state not yet known to lead to a won state; -1 once the state is labelled
+    moves_left = array.array("q",[0]) * num_states
+    work_queue = collections.deque()
+    for state_id in range(num_states):
+        vertex = graph.find_state(compiled.get_key(state_id))
+        game_result = vertex.game_result() if hasattr(vertex,"game_result") else None
+        num_moves = offsets[state_id+1] - offsets[state_id]
+        if game_result is None and num_moves == 0:
+            game_result = RESULT_LOSS
+        if game_result is None:
+            moves_left[state_id] = num_moves
+        else:
+            labels[state_id] = game_result
+            moves_left[state_id] = -1
+            if game_result != RESULT_DRAW:
+                work_queue.append(state_id)
+
+    # The queue is in order of depth, so a lost state is labelled by its deepest move
+    while work_queue:
+        state_id = work_queue.popleft()
+        state_won = labels[state_id] == RESULT_WIN
+        for pred_pos in range(pred_offsets[state_id],pred_offsets[state_id+1]):
+            pred_id = pred_sources[pred_pos]
+            if moves_left[pred_id] <= 0:
+                continue # already labelled
+            if state_won:
+                moves_left[pred_id] -= 1
+                if moves_left[pred_id] > 0:
+                    continue
+                labels[pred_id] = RESULT_LOSS
+            else:
+                labels[pred_id] = RESULT_WIN
+            moves_left[pred_id] = -1
+            depths[pred_id] = depths[state_id] + 1
+            work_queue.append(pred_id)
+
+    return RetrogradeTable(compiled,labels,depths)
+
+# The result of retrograde_analysis: a label (RESULT_*) and a depth for every state of a CompiledGraph, in two arrays
+# indexed by state number.  save() writes it as an endgame table, which load_retrograde_table() memory-maps again
+class RetrogradeTable(object):
+    def __init__(self,compiled,labels,depths):
+        self.compiled = compiled
+        self.labels = labels
+        self.depths = depths
+
+    def state_id(self,key):
+        state_id = self.compiled.get_id(key)
+        if state_id is None:
+            raise RuntimeError("State {} is not in the table".format(key))
+        return state_id
+
+    def get_result(self,key):
+        return self.labels[self.state_id(key)]
+
+    def get_depth(self,key):
+        return self.depths[self.state_id(key)]
+
+    def best_move(self,key):
+        # An edge which keeps the result: to a lost state as fast as possible from a won state, to a won state as
+        # slowly as possible from a lost one, to a drawn state from a drawn one.  None if the game is over
+        compiled = self.compiled
+        state_id = self.state_id(key)
+        label = self.labels[state_id]
+        if label != RESULT_DRAW and self.depths[state_id] == 0:
+            return None
+        for edge_idx in range(compiled.offsets[state_id],compiled.offsets[state_id+1]):
+            target_id = compiled.targets[edge_idx]
+            target_label = self.labels[target_id]
+            if label == RESULT_DRAW:
+                keeps_result = target_label == RESULT_DRAW
+            else:
+                keeps_result = target_label != label and target_label != RESULT_DRAW and self.depths[target_id] == self.depths[state_id] - 1
+            if keeps_result:
+                return real_edge(compiled.get_edge(edge_idx))
+        return None
+
+    def best_line(self,key,max_moves=None):
+        # The list of best moves from a state to the end of the game (or max_moves of them; draws may go on forever)
+        line = list()
+        while max_moves is None or len(line) < max_moves:
+            edge = self.best_move(key)
+            if edge is None:
+                break
+            line.append(edge)
+            key = edge.get_dst_key()
+        return line
+
+    def save(self,path):
+        self.compiled.save(path,[("labels",bytes(self.labels)),("depths",self.depths.tobytes())])
+
+    def close(self):
+        # Only needed for tables loaded with load_retrograde_table()
+        if isinstance(self.compiled,MappedGraph):
+            self.labels.release()
+            self.depths.release()
+            self.compiled.close()
+
+# Load an endgame table written by RetrogradeTable.save().  "graph" is as for MappedGraph
+def load_retrograde_table(path,graph):
+    mapped = MappedGraph(path,graph)
+    labels = mapped.get_section("labels","B")
+    depths = mapped.get_section("depths","q")
+    if labels is None or depths is None:
+        mapped.close()
+        raise RuntimeError("{} is a saved graph, not an endgame table".format(path))
+    return RetrogradeTable(mapped,labels,depths)
@@ -0,0 +1,78 @@
+import collections
+import os
+import tempfile
+
+import gamegraph
+
+# Nim, a two-player game for retrograde_analysis
+# There are several heaps of objects.  A move takes any number of objects (at least one, at most "max_take" if given)
+# from one heap.  In normal play, whoever takes the last object wins; in misere play, whoever takes it loses
+# The game is impartial (both players have the same moves), so the key need not say whose turn it is
+# The heaps are interchangeable, so the key is the tuple of heap sizes in sorted order
+
+class NimGameVertex(gamegraph.GameVertex):
+    __slots__ = ()
+
+    def gen_outgoing_keys(self):
+        max_take = self.graph.max_take
+        seen_keys = set()
+        for heap_idx,heap_size in enumerate(self.key):
+            if heap_idx > 0 and heap_size == self.key[heap_idx-1]:
+                continue # the same moves as the previous heap
+            for taken in range(1,heap_size+1 if max_take is None else min(heap_size,max_take)+1):
+                new_heaps = list(self.key)
+                new_heaps[heap_idx] -= taken
+                new_key = tuple(sorted(new_heaps))
+                if new_key not in seen_keys:
+                    seen_keys.add(new_key)
+                    yield new_key
+
+    def game_result(self):
+        if any(self.key):
+            return None
+        # The previous player took the last object
+        return gamegraph.RESULT_WIN if self.graph.misere else gamegraph.RESULT_LOSS
+
+class NimGameEdge(gamegraph.GameEdge):
+    __slots__ = ()
+
+    def __init__(self,src,dst,graph):
+        super().__init__(src,dst,graph)
+        # The only heap whose size changed: the size left over on each side when the others are matched up
+        old_size, = collections.Counter(src.get_key()) - collections.Counter(dst.get_key())
+        new_size, = collections.Counter(dst.get_key()) - collections.Counter(src.get_key())
+        super().set_key((old_size,new_size))
+        super().set_name("take {} from a heap of {}".format(old_size - new_size,old_size))
+
+class NimGameGraph(gamegraph.GameGraph):
+    # "heaps" is the list of heap sizes at the start.  Only the states reachable from it are built
+    # With mode="lazy" nothing is built up front: enough for reading a table from load_retrograde_table()
+    def __init__(self,heaps,max_take=None,misere=False,incoming_edges=False,stats=None,deferred_edges=False,mode="reachable"):
+        self.max_take = max_take
+        self.misere = misere
+        self.start_key = tuple(sorted(heaps))
+        super().__init__(NimGameVertex,NimGameEdge,mode,incoming_edges,stats,deferred_edges)
+        if mode == "reachable":
+            self.build_reachable(self.start_key)
+
+if __name__=="__main__":
+    for misere in (False,True):
+        nim_graph = NimGameGraph([3,4,5],misere=misere)
+        table = gamegraph.retrograde_analysis(nim_graph)
+        start = nim_graph.start_key
+        print("nim {}{}: {} for the first player in {} moves".format(start," (misere)" if misere else "",
+                                                                  gamegraph.RESULT_NAMES[table.get_result(start)],table.get_depth(start)))
+        for move_num, move in enumerate(table.best_line(start)):
+            print("{}. {} -> {}".format(move_num+1,str(move),move.get_dst_key()))
+
+    # A saved table answers later queries without building or solving the game again
+    with tempfile.TemporaryDirectory() as table_dir:
+        table_path = os.path.join(table_dir,"nim.table")
+        gamegraph.retrograde_analysis(NimGameGraph([3,4,5,6])).save(table_path)
+        lazy_graph = NimGameGraph([3,4,5,6],mode="lazy")
+        table = gamegraph.load_retrograde_table(table_path,lazy_graph)
+        for heaps in ((3,4,5,6),(0,1,2,3),(2,2,5,6)):
+            print("nim {} from the saved table: {} in {} moves, first move {}".format(heaps,gamegraph.RESULT_NAMES[table.get_result(heaps)],
+                                                                                   table.get_depth(heaps),table.best_move(heaps)))
+        print("states built to answer them: {}".format(len(lazy_graph.graph)))
+        table.close()